@@ -0,0 +1,5 @@
+from . import config, default_config
+
+for _name in dir(default_config):
+    if _name.isupper() and not hasattr(config, _name):
+        setattr(config, _name, getattr(default_config, _name))
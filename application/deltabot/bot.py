@@ -1,40 +1,210 @@
 from datetime import datetime
+import heapq
+import itertools
+import json
 import logging
-from operator import attrgetter
-import re
+from operator import itemgetter
+import string
 import threading
+import time
 
 from cached_property import cached_property
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
-from . import config, utils
-from .models import Delta
+from . import config, metrics, utils
+from .models import (Delta, KeyValueStore, PendingFlair, ProcessedItems,
+                     UserHistory, UserStats)
+
+# Everything used to be stored in this single entity group
+_LEGACY_ANCESTOR = ndb.Key('_dummy', 1)
 
 
 def _query_user_deltas(username):
-    return utils.query_delta(Delta.awarded_to == username,
+    return utils.query_delta(ancestor=utils.user_key(username),
                              include_removed=False)
 
 
-def _get_user_delta_count(username):
-    return _query_user_deltas(username).count(keys_only=True)
+@ndb.tasklet
+def _compute_user_stats_async(username, excluded_delta_key=None):
+    stats = UserStats(key=utils.user_key(username))
+    deltas = yield _query_user_deltas(username).fetch_async()
+    for delta in deltas:
+        if delta.key != excluded_delta_key:
+            stats.add_delta(delta)
+    raise ndb.Return(stats)
+
+
+def _compute_user_stats(username, excluded_delta_key=None):
+    return _compute_user_stats_async(username,
+                                     excluded_delta_key).get_result()
+
+
+@ndb.tasklet
+def _get_user_stats_async(username):
+    stats = yield utils.user_key(username).get_async()
+    if stats is None:
+        # Stats are only stored once a delta is added or removed, or the
+        # counters are rebuilt
+        stats = yield _compute_user_stats_async(username)
+    raise ndb.Return(stats)
+
+
+def _get_user_stats(username):
+    return _get_user_stats_async(username).get_result()
+
+
+@ndb.transactional_tasklet
+def _rebuild_user_stats_async(username):
+    """Recompute a user's stats, and return whether the stored ones differed"""
+    stats, stored_stats = yield (_compute_user_stats_async(username),
+                                 utils.user_key(username).get_async())
+    if stats == stored_stats:
+        raise ndb.Return(False)
+    yield stats.put_async()
+    raise ndb.Return(True)
+
+
+REBUILD_BATCH_SIZE = 20
 
 
 # Deferred
-def update_user_flair(username):
-    logging.debug("Updating /u/{}'s flair".format(username))
-    
-    r = utils.get_reddit()
-    delta_count = _get_user_delta_count(username)
-    
-    if delta_count == 0:
-        r.delete_flair(config.SUBREDDIT, username)
+def rebuild_user_stats():
+    """Recompute every user's stats from the Delta entities
+    
+    The stats are maintained transactionally along with the deltas, so this
+    is only needed to repair drift or to backfill them, e.g. once the
+    migration has moved the deltas that were missed meanwhile.  Users whose
+    stats were wrong get their flair and wiki page updated as well.
+    """
+    logging.debug('Rebuilding user stats')
+    
+    usernames = set()
+    qry = Delta.query(projection=[Delta.awarded_to], distinct=True)
+    for delta in qry:
+        usernames.add(delta.awarded_to)
+    # Users whose deltas have all been removed since
+    for key in UserStats.query().iter(keys_only=True):
+        usernames.add(key.id())
+    
+    # Each user is its own entity group, so they can be rebuilt concurrently
+    usernames = sorted(usernames)
+    rebuilt_usernames = []
+    for i in range(0, len(usernames), REBUILD_BATCH_SIZE):
+        batch = usernames[i:i + REBUILD_BATCH_SIZE]
+        futures = [_rebuild_user_stats_async(username) for username in batch]
+        for username, future in zip(batch, futures):
+            if future.get_result():
+                rebuilt_usernames.append(username)
+    
+    logging.debug('Rebuilt stats of {} users'.format(len(rebuilt_usernames)))
+    if rebuilt_usernames:
+        ndb.put_multi([PendingFlair(id=username)
+                       for username in rebuilt_usernames])
+        utils.defer_reddit_coalesced('flair-outbox', flush_flair_outbox,
+                                     _lane='flair')
+    for username in rebuilt_usernames:
+        utils.defer_reddit_coalesced('user-wiki-' + username,
+                                     update_user_wiki_page, username,
+                                     _lane='bulk')
+    utils.defer_reddit(update_tracker_wiki_page, _lane='bulk')
+
+
+# Reddit's limit
+FLAIR_CSV_BATCH_SIZE = 100
+FLAIR_MAX_ATTEMPTS = 3
+
+
+def _get_flair_text(delta_count):
+    # An empty flair deletes the user's flair
+    return str(delta_count) + config.DELTA if delta_count else ''
+
+
+def queue_user_flair(username):
+    """Queue an update of the user's flair for the next outbox flush"""
+    PendingFlair(id=username).put()
+    utils.defer_reddit_coalesced('flair-outbox', flush_flair_outbox,
+                                 _lane='flair')
+
+
+@ndb.transactional_tasklet
+def _update_pending_flair_async(flair, sent):
+    stored_flair = yield flair.key.get_async()
+    if not stored_flair:
+        return
+    
+    if sent:
+        # Flairs queued again since they were read have to be sent again
+        if stored_flair.queued_at == flair.queued_at:
+            yield stored_flair.key.delete_async()
+        return
+    
+    stored_flair.attempts += 1
+    if stored_flair.attempts < FLAIR_MAX_ATTEMPTS:
+        yield stored_flair.put_async()
     else:
-        flair_text = str(delta_count) + config.DELTA
-        r.set_flair(config.SUBREDDIT, username, flair_text)
+        logging.error("Giving up on /u/{}'s flair".format(flair.key.id()))
+        yield stored_flair.key.delete_async()
 
 
 # Deferred
+@metrics.timed('flush_flair_outbox')
+def flush_flair_outbox():
+    pending_flairs = PendingFlair.query().fetch(FLAIR_CSV_BATCH_SIZE)
+    if not pending_flairs:
+        return
+    
+    logging.debug('Flushing {} flairs'.format(len(pending_flairs)))
+    
+    usernames = [flair.key.id() for flair in pending_flairs]
+    # The gets are batched, and missing stats computed concurrently
+    stats_futures = [_get_user_stats_async(username)
+                     for username in usernames]
+    flair_texts = {}
+    for username, stats_future in zip(usernames, stats_futures):
+        delta_count = stats_future.get_result().delta_count
+        flair_texts['flair:' + username] = _get_flair_text(delta_count)
+    
+    # Flairs that are already what they'd be set to count as sent
+    changed_targets = utils.get_changed_targets(flair_texts)
+    flair_mapping = [{'user': username,
+                      'flair_text': flair_texts['flair:' + username]}
+                     for username in usernames
+                     if 'flair:' + username in changed_targets]
+    results = {}
+    if flair_mapping:
+        r = utils.get_reddit()
+        csv_results = r.set_flair_csv(config.SUBREDDIT, flair_mapping)
+        for mapping, result in zip(flair_mapping, csv_results):
+            results[mapping['user']] = result
+    
+    # Each pending flair is its own entity group, so they can be updated
+    # concurrently
+    any_failed = False
+    futures = []
+    written = {}
+    for flair in pending_flairs:
+        username = flair.key.id()
+        result = results.get(username, {'ok': True})
+        if not result['ok']:
+            logging.warning("Couldn't update /u/{}'s flair: {}"
+                            .format(username, result['errors']))
+            any_failed = True
+        elif username in results:
+            target = 'flair:' + username
+            written[target] = flair_texts[target]
+        futures.append(_update_pending_flair_async(flair, result['ok']))
+    utils.set_written(written)
+    for future in futures:
+        future.check_success()
+    
+    if any_failed or len(pending_flairs) == FLAIR_CSV_BATCH_SIZE:
+        utils.defer_reddit_coalesced('flair-outbox', flush_flair_outbox,
+                                     _lane='flair')
+
+
+# Deferred
+@metrics.timed('update_submission_flair')
 def update_submission_flair(awarder_comment):
     logging.debug('Updating flair of submission (comment {})'
                   .format(awarder_comment.id))
@@ -49,55 +219,225 @@ def update_submission_flair(awarder_comment):
     
     flair_text = '[Deltas Awarded]' if has_op_delta else None
     flair_class = 'OPdelta' if has_op_delta else None
+    
+    flair = {'submission-flair:' + submission.id:
+             json.dumps([flair_text, flair_class])}
+    if not utils.get_changed_targets(flair):
+        logging.debug('Submission flair unchanged')
+        return
     r.set_flair(config.SUBREDDIT, submission, flair_text, flair_class)
+    utils.set_written(flair)
 
 
-def _get_user_deltas(username):
-    qry = _query_user_deltas(username)
-    deltas = qry.fetch()
-    # Have to sort manually since NDB requires that the first sort property
-    # must be the same as the property to which the inequality filter is
-    # applied.
-    deltas.sort(key=attrgetter('awarded_at'), reverse=True)
-    return deltas
+# Bump when the format of the cached rows changes
+USER_HISTORY_SCHEMA = 1
 
+_EPOCH = datetime(1970, 1, 1)
 
-# Deferred
-def update_user_wiki_page(username):
-    logging.debug("Updating /u/{}'s wiki page".format(username))
+
+def _get_user_history_version():
+    return '{}:{}'.format(USER_HISTORY_SCHEMA, utils.get_template_fingerprint(
+        'wiki/user_history_row.md'))
+
+
+def _render_user_history_row(delta):
+    row_md = utils.render_template('wiki/user_history_row.md', delta=delta)
+    return [delta.key.id(), (delta.awarded_at - _EPOCH).total_seconds(),
+            row_md]
+
+
+def _get_user_history_rows(username):
+    """Return the rendered rows of a user's wiki page, latest first
+    
+    Rows are cached by delta, so only the deltas added since the last update
+    are fetched and rendered, and those removed since are dropped.
+    """
+    history_key = ndb.Key(UserHistory, username)
+    history_future = history_key.get_async()
+    # Ancestor query, so strongly consistent
+    delta_keys = _query_user_deltas(username).fetch(keys_only=True)
+    history = history_future.get_result()
+    
+    version = _get_user_history_version()
+    if history is None or history.version != version:
+        history = UserHistory(key=history_key, version=version, rows=[])
+    
+    delta_ids = set(key.id() for key in delta_keys)
+    rows = [row for row in history.rows if row[0] in delta_ids]
+    cached_ids = set(row[0] for row in rows)
+    new_deltas = ndb.get_multi([key for key in delta_keys
+                                if key.id() not in cached_ids])
+    new_rows = [_render_user_history_row(delta) for delta in new_deltas
+                if delta is not None]
+    
+    if new_rows or len(rows) != len(history.rows):
+        rows.extend(new_rows)
+        # Have to sort manually since NDB requires that the first sort
+        # property must be the same as the property to which the inequality
+        # filter is applied.
+        rows.sort(key=itemgetter(1), reverse=True)
+        history.rows = rows
+        history.put()
+    return [row_md for _, _, row_md in rows]
+
+
+def _edit_wiki_page(page, content_md):
+    """Edit a wiki page, unless it's what was last written to it
     
-    deltas = _get_user_deltas(username)
-    content_md = utils.render_template('wiki/user_history.md',
-                                       username=username, deltas=deltas)
+    Returns whether it was edited.
+    """
+    page_content = {'wiki:' + page: content_md}
+    if not utils.get_changed_targets(page_content):
+        logging.debug('Wiki page {} unchanged'.format(page))
+        return False
     
     r = utils.get_reddit()
-    r.edit_wiki_page(config.SUBREDDIT, 'user/{}'.format(username), content_md)
+    r.edit_wiki_page(config.SUBREDDIT, page, content_md)
+    utils.set_written(page_content)
+    return True
 
 
-def _get_deltas_grouped_by_users():
-    qry = utils.query_delta(include_removed=False)
-    deltas_by_user = {}
-    
-    for delta in qry:
-        user_delta = deltas_by_user.get(delta.awarded_to)
-        if not user_delta or user_delta.awarded_at < delta.awarded_at:
-            deltas_by_user[delta.awarded_to] = delta
-    
-    deltas = deltas_by_user.values()
-    deltas.sort(key=attrgetter('awarded_to'))
+# Deferred
+@metrics.timed('update_user_wiki_page')
+def update_user_wiki_page(username):
+    logging.debug("Updating /u/{}'s wiki page".format(username))
     
-    return deltas
+    rows = _get_user_history_rows(username)
+    with metrics.timer('render_user_history'):
+        content_md = utils.render_template('wiki/user_history.md',
+                                           username=username, rows=rows)
+    _edit_wiki_page('user/{}'.format(username), content_md)
+
+
+# The tracker has a page per username initial
+TRACKER_SHARDS = tuple(string.ascii_lowercase) + ('other',)
+
+
+def get_tracker_shard(username):
+    initial = username[:1].lower()
+    return initial if 'a' <= initial <= 'z' else 'other'
+
+
+def _get_shard_ranges(shard):
+    """Return the ranges of usernames of a tracker shard, as (start, end)"""
+    if shard is None:
+        return [(None, None)]
+    elif shard == 'other':
+        # Usernames are made of letters, digits, '-' and '_'
+        return [(None, 'A'), ('[', 'a'), ('{', None)]
+    else:
+        upper = shard.upper()
+        return [(upper, chr(ord(upper) + 1)), (shard, chr(ord(shard) + 1))]
+
+
+def _get_tracker_users(shard=None):
+    """Return the stats of the users who earned deltas, sorted by username
+    
+    Only the users of the given tracker shard, if any.
+    """
+    futures = []
+    for start, end in _get_shard_ranges(shard):
+        # Stats are keyed by username
+        qry = UserStats.query()
+        if start:
+            qry = qry.filter(UserStats.key >= utils.user_key(start))
+        if end:
+            qry = qry.filter(UserStats.key < utils.user_key(end))
+        futures.append(qry.fetch_async())
+    
+    users = [stats for future in futures for stats in future.get_result()
+             if stats.delta_count > 0]
+    users.sort(key=lambda stats: stats.username.lower())
+    return users
+
+
+def _update_tracker_shard(shard, users):
+    with metrics.timer('render_tracker'):
+        content_md = utils.render_template('wiki/tracker.md', shard=shard,
+                                           users=users)
+    return _edit_wiki_page('deltabot/tracker/' + shard, content_md)
 
 
 # Deferred
-def update_tracker_wiki_page():
-    logging.debug('Updating tracker wiki page')
-    
-    deltas = _get_deltas_grouped_by_users()
-    content_md = utils.render_template('wiki/tracker.md', deltas=deltas)
-    
-    r = utils.get_reddit()
-    r.edit_wiki_page(config.SUBREDDIT, 'deltabot/tracker', content_md)
+@metrics.timed('update_tracker_index')
+def update_tracker_index():
+    content_md = utils.render_template('wiki/tracker_index.md',
+                                       shards=TRACKER_SHARDS)
+    _edit_wiki_page('deltabot/tracker', content_md)
+
+
+# Deferred
+@metrics.timed('update_tracker_wiki_page')
+def update_tracker_wiki_page(shard=None):
+    """Update a page of the tracker, or all of them and the index"""
+    if shard:
+        logging.debug('Updating tracker wiki page {}'.format(shard))
+        if _update_tracker_shard(shard, _get_tracker_users(shard)):
+            # The index links to the page, which may be new
+            utils.defer_reddit_coalesced('tracker-index', update_tracker_index,
+                                         _lane='bulk')
+        return
+    
+    logging.debug('Updating tracker wiki pages')
+    
+    users_by_shard = dict((shard, []) for shard in TRACKER_SHARDS)
+    for stats in _get_tracker_users():
+        users_by_shard[get_tracker_shard(stats.username)].append(stats)
+    # Unchanged pages aren't edited again
+    for shard in TRACKER_SHARDS:
+        _update_tracker_shard(shard, users_by_shard[shard])
+    update_tracker_index()
+
+
+# Deferred
+@metrics.timed('queue_reddit_updates')
+def queue_reddit_updates(awarder_comment, awardee_username):
+    """Queue the flair and wiki updates following a delta change
+    
+    Updates of the same user, submission or tracker page are coalesced, so
+    that a user earning several deltas in a row only gets their flair and
+    wiki pages updated once.  User flairs are sent in batches through the
+    outbox.
+    """
+    submission_id = utils.fullname_to_id(awarder_comment.link_id)
+    utils.defer_reddit_coalesced('submission-flair-' + submission_id,
+                                 update_submission_flair, awarder_comment,
+                                 _lane='flair')
+    queue_user_flair(awardee_username)
+    utils.defer_reddit_coalesced('user-wiki-' + awardee_username,
+                                 update_user_wiki_page, awardee_username,
+                                 _lane='bulk')
+    shard = get_tracker_shard(awardee_username)
+    utils.defer_reddit_coalesced('tracker-' + shard, update_tracker_wiki_page,
+                                 shard, _lane='bulk')
+
+
+@ndb.non_transactional
+def _find_delta(awarder_comment_id):
+    """Return the delta of an awarder comment, whoever its awardee
+    
+    Outside of any transaction, since the delta may be in any entity group.
+    """
+    # Eventually consistent
+    qry = utils.query_delta(Delta.awarder_comment_id == awarder_comment_id,
+                            include_removed=True)
+    delta_key = qry.get(keys_only=True)
+    return delta_key.get() if delta_key else None
+
+
+@ndb.non_transactional
+def _is_legacy_awarded(awarder_username, awardee_username, submission_id):
+    """Return whether a delta not migrated yet was awarded on the submission
+    
+    Until migrate_storage() has moved them, deltas are in the legacy entity
+    group, so the query is strongly consistent.
+    """
+    qry = utils.query_delta(Delta.awarded_by == awarder_username,
+                            Delta.awarded_to == awardee_username,
+                            Delta.submission_id == submission_id,
+                            ancestor=_LEGACY_ANCESTOR,
+                            include_removed=False)
+    return qry.get(keys_only=True) is not None
 
 
 class BooleanReason(object):
@@ -111,11 +451,20 @@ class BooleanReason(object):
 class ItemProcessor(object):
     @cached_property
     def _is_queuable(self):
-        return BooleanReason(self._check_queuable())
+        return self._check('queuable', self._check_queuable)
     
     @cached_property
     def _is_processable(self):
-        return BooleanReason(self._check_processable())
+        return self._check('processable', self._check_processable)
+    
+    def _check(self, check, check_function):
+        processor = type(self).__name__
+        with metrics.timer('{}.check_{}'.format(processor, check)):
+            reason_not = check_function()
+            metrics.increment_on_commit(metrics.CHECK_RESULTS,
+                                        processor=processor, check=check,
+                                        reason=reason_not or 'ok')
+        return BooleanReason(reason_not)
     
     def _check_queuable(self):
         raise NotImplementedError
@@ -148,10 +497,17 @@ class CommentProcessor(ItemProcessor):
     @cached_property
     def _stored_delta(self):
         comment_id = self._awarder_comment.id
-        qry = utils.query_delta(Delta.awarder_comment_id == comment_id,
-                                include_removed=True)
-        return qry.get()
-    
+        awardee = getattr(self._awardee_comment, 'author', None)
+        awardee_username = getattr(awardee, 'name', None)
+        if awardee_username:
+            delta = utils.delta_key(awardee_username, comment_id).get()
+            if delta:
+                return delta
+        # The awardee comment may have been deleted since, or its author's
+        # name stored with a different case
+        return _find_delta(comment_id)
+    
+    @metrics.timed('reply_to_comment')
     def _reply_to_comment(self, error):
         awardee_username = getattr(self._awarder_comment.author, 'name', None)
         reply_text = utils.render_template(self.COMMENT_TEMPLATE,
@@ -171,6 +527,7 @@ class CommentProcessor(ItemProcessor):
             # XXX: We should probably find a workaround anyway.
             logging.warning("Couldn't distinguish comment")
     
+    @metrics.timed('reply_to_message')
     def _reply_to_message(self, error):
         awardee_username = getattr(self._awarder_comment.author, 'name', None)
         reply_text = utils.render_template(self.MESSAGE_TEMPLATE,
@@ -181,11 +538,9 @@ class CommentProcessor(ItemProcessor):
     @ndb.transactional
     def _update_reddit(self):
         """If called, must do so after _update_records() call"""
-        awarder_comment = self._awarder_comment
         awardee_username = self._awardee_comment.author.name
-        utils.defer_reddit(update_submission_flair, awarder_comment)
-        utils.defer_reddit(update_user_flair, awardee_username)
-        utils.defer_reddit(update_user_wiki_page, awardee_username)
+        utils.defer(queue_reddit_updates, self._awarder_comment,
+                    awardee_username)
     
     def _update_records(self):
         raise NotImplementedError
@@ -198,6 +553,7 @@ class CommentProcessor(ItemProcessor):
         elif self._message:
             utils.defer_reddit(self._reply_to_message, error)
     
+    @metrics.timed('process_comment')
     @ndb.transactional
     def _process(self):
         error = self._is_processable.reason_not
@@ -213,13 +569,17 @@ class CommentProcessor(ItemProcessor):
             self._update_reddit()
 
 
+def _prefetch_awardee_comments(processors):
+    """Fetch the awardee comments of several processors at once"""
+    parent_ids = [processor._awarder_comment.parent_id
+                  for processor in processors]
+    parents = utils.get_things(parent_ids)
+    for processor, parent_id in zip(processors, parent_ids):
+        if parent_id in parents:
+            processor._awardee_comment = parents[parent_id]
+
+
 class DeltaAdder(CommentProcessor):
-    # Assume expanded tabs
-    RE_INLINE_CODE = re.compile(r'`[^`]+`')
-    RE_BLOCK_QUOTE = re.compile(r'(?ms)^\x20{0,3}>(.+?)\n\n')
-    RE_CODE_BLOCK = re.compile(r'(^\n?|\n\n)\x20{4}.+(\n(\x20{4}.+|\x20*))*'
-                               r'(\n|$)')
-    
     COMMENT_TEMPLATE = 'comments/delta_adder.md'
     MESSAGE_TEMPLATE = 'messages/delta_adder.md'
     
@@ -228,18 +588,16 @@ class DeltaAdder(CommentProcessor):
         self._force = force
     
     def _has_delta_token(self):
-        text = self._awarder_comment.body.expandtabs(4)
-        text = self.RE_CODE_BLOCK.sub('', text)
-        text = self.RE_BLOCK_QUOTE.sub('', text + '\n\n')[:-2]
-        text = self.RE_INLINE_CODE.sub('', text)
         delta_tokens = (config.DELTA,) + config.DELTA_ALIASES
-        return any((token in text) for token in delta_tokens)
+        return utils.has_unquoted_token(self._awarder_comment.body,
+                                        delta_tokens)
     
     def _update_records(self):
         awarded_at = datetime.fromtimestamp(self._awarder_comment.created_utc)
         awarder_comment_url = utils.get_comment_url(self._awarder_comment)
-        delta = utils.ndb_model(
-            Delta,
+        awardee_username = self._awardee_comment.author.name
+        delta = Delta(
+            key=utils.delta_key(awardee_username, self._awarder_comment.id),
             awarded_at=awarded_at,
             awarded_by=self._awarder_comment.author.name,
             awarded_to=self._awardee_comment.author.name,
@@ -248,7 +606,9 @@ class DeltaAdder(CommentProcessor):
             submission_id=self._submission_id,
             submission_title=self._awarder_comment.link_title,
             submission_url=self._awarder_comment.link_url)
-        delta.put()
+        stats = _get_user_stats(delta.awarded_to)
+        stats.add_delta(delta)
+        ndb.put_multi([delta, stats])
     
     def _check_queuable(self):
         if not self._awarder_comment.author:
@@ -263,14 +623,24 @@ class DeltaAdder(CommentProcessor):
         awardee_username = self._awardee_comment.author.name
         op_username = self._awarder_comment.link_author
         
+        # Ancestor query, so strongly consistent
         already_awarded_qry = utils.query_delta(
             Delta.awarded_by == awarder_username,
-            Delta.awarded_to == awardee_username,
             Delta.submission_id == self._submission_id,
+            ancestor=utils.user_key(awardee_username),
             include_removed=False)
+        already_awarded_future = already_awarded_qry.get_async(keys_only=True)
+        # Needed by _update_records(), so fetched meanwhile into the context
+        # cache, which is per transaction attempt
+        stats_future = utils.user_key(awardee_username).get_async()
+        already_awarded = (already_awarded_future.get_result() or
+                           _is_legacy_awarded(awarder_username,
+                                              awardee_username,
+                                              self._submission_id))
+        stats_future.wait()
         
         # Conditions order important
-        if already_awarded_qry.get(keys_only=True):
+        if already_awarded:
             return 'already_awarded'
         elif self._awarder_comment.is_root:
             return 'toplevel_comment'
@@ -313,7 +683,9 @@ class DeltaApprover(CommentProcessor):
     def _update_reddit(self):
         pass
     
-    @ndb.transactional
+    @metrics.timed('approve_delta')
+    # The stored delta may not be in the awardee's entity group
+    @ndb.transactional(xg=True)
     def _process(self):
         error = self._is_processable.reason_not
         utils.defer_reddit(self._reply_to_message, error)
@@ -344,6 +716,7 @@ class DeltaRemover(CommentProcessor):
         else:
             return None
     
+    @metrics.timed('reply_to_comment')
     def _reply_to_comment(self, error):
         awardee_username = getattr(self._awarder_comment.author, 'name', None)
         reply_text = utils.render_template(self.COMMENT_TEMPLATE,
@@ -365,10 +738,18 @@ class DeltaRemover(CommentProcessor):
             logging.warning("Couldn't distinguish comment")
     
     def _update_records(self):
-        self._stored_delta.status = 'removed_' + self._removal_reason
-        self._stored_delta.put()
-    
-    @ndb.transactional
+        delta = self._stored_delta
+        delta.status = 'removed_' + self._removal_reason
+        # The removed delta may have been the user's latest one, so the stats
+        # can't just be decremented.  The status change isn't visible to the
+        # query within the transaction, hence the exclusion.
+        stats = _compute_user_stats(delta.awarded_to,
+                                    excluded_delta_key=delta.key)
+        ndb.put_multi([delta, stats])
+    
+    @metrics.timed('remove_delta')
+    # The stored delta may not be in the awardee's entity group
+    @ndb.transactional(xg=True)
     def _process(self):
         error = self._is_processable.reason_not
         utils.defer_reddit(self._reply_to_message, error)
@@ -448,9 +829,7 @@ class CommandMessageProcessor(ItemProcessor):
             return None
     
     def _check_processable(self):
-        r = utils.get_reddit()
-        moderators = r.get_moderators(config.SUBREDDIT)
-        moderator_usernames = set(moderator.name for moderator in moderators)
+        moderator_usernames = utils.get_moderator_usernames(config.SUBREDDIT)
         
         if self._message.author.name not in moderator_usernames:
             return 'not_a_mod'
@@ -461,14 +840,17 @@ class CommandMessageProcessor(ItemProcessor):
         else:
             return None
     
+    @metrics.timed('reply_to_message')
     def _reply_to_message(self, error):
-        reply_text = utils.render_template('messages/command.md', error=error)
+        reply_text = utils.render_template_cached('messages/command.md',
+                                                  error=error)
         self._message.reply(reply_text)
     
     def _queue(self):
         if self._is_queuable:
             utils.defer_reddit(self._process)
     
+    @metrics.timed('process_command')
     def _process(self):
         if self._is_processable:
             command_name = self._get_command_name()
@@ -478,38 +860,271 @@ class CommandMessageProcessor(ItemProcessor):
             utils.defer_reddit(self._reply_to_message, error)
 
 
+PROCESSED_ITEMS_BUCKET_SIZE = 3600
+PURGE_BATCH_SIZE = 500
+
+# Reddit's limit
+LISTING_PAGE_SIZE = 100
+# How far out of creation order listed items may be
+REORDER_BUFFER_SIZE = 100
+# App Engine's limit of tasks enqueued in a transaction
+MAX_TRANSACTIONAL_TASKS = 5
+# App Engine's limit of entity groups in a transaction, minus the placeholder,
+# since each item may have its own shard of processed items
+MAX_PROCESSING_BATCH_SIZE = 24
+PREFETCH_CHUNK_SIZE = 100
+
+
+def _get_bucket(item):
+    return int(item.created_utc // PROCESSED_ITEMS_BUCKET_SIZE)
+
+
+def _get_retention_cutoff():
+    """Return the oldest bucket of processed items that is kept"""
+    retention = config.PROCESSED_ITEMS_RETENTION
+    return int((time.time() - retention) // PROCESSED_ITEMS_BUCKET_SIZE)
+
+
+def _get_id_value(item):
+    return int(item.id, 36)
+
+
+def _iter_reordered(items, buffer_size):
+    """Yield items by creation time
+    
+    Items must be at most buffer_size positions away from their place.
+    """
+    heap = []
+    for item in items:
+        heapq.heappush(heap, (item.created_utc, item.id, item))
+        if len(heap) > buffer_size:
+            yield heapq.heappop(heap)[-1]
+    while heap:
+        yield heapq.heappop(heap)[-1]
+
+
+@ndb.non_transactional
+def _get_legacy_processed_ids(item_ids):
+    """Return the ids marked processed by the previous scheme
+    
+    Its markers are kept until purge_processed_items() deletes them.
+    """
+    keys = [ndb.Key(KeyValueStore, 'processed_comments:' + item_id,
+                    parent=_LEGACY_ANCESTOR)
+            for item_id in item_ids]
+    return set(item_id for item_id, marker
+               in zip(item_ids, ndb.get_multi(keys)) if marker is not None)
+
+
 class ItemsConsumer(object):
+    # Runs are also serialized across instances by their queue
     _lock = None
     
     PROCESSOR = None
     PLACEHOLDER_KEY = None
+    # Placeholder of the previous scheme, under the legacy ancestor
+    LEGACY_PLACEHOLDER_KEY = None
     PROCESSED_KEY = None
+    FULLNAME_PREFIX = None
     
-    def _fetch_items(self):
+    def _fetch_items(self, **kwargs):
         raise NotImplementedError
     
+    def _fetch_page(self, before_id):
+        # Listings are sorted from newest to oldest, and 'before' returns the
+        # items just above the given one.  The placeholder makes PRAW stop
+        # instead of going on with the older items, if the page isn't full.
+        params = {'before': self.FULLNAME_PREFIX + before_id}
+        return self._fetch_items(limit=LISTING_PAGE_SIZE, params=params,
+                                 place_holder=before_id)
+    
+    def _iter_new_items(self):
+        """Yield the items created since the placeholder, page by page"""
+        before_id = self._placeholder
+        while before_id:
+            before_value = int(before_id, 36)
+            with self._timer('fetch'):
+                page = [item for item in self._fetch_page(before_id)
+                        if _get_id_value(item) > before_value]
+            logging.debug('Page of items: {}'.format(len(page)))
+            if not page:
+                break
+            
+            with self._timer('sort'):
+                page.sort(key=_get_id_value)
+            for item in page:
+                yield item
+            
+            if len(page) < LISTING_PAGE_SIZE:
+                return
+            before_id = page[-1].id
+        
+        if before_id == self._placeholder:
+            # Either nothing is new or the placeholder item is gone, in which
+            # case Reddit returns nothing.  Go through the whole listing
+            # instead, which has to be held in memory to be reversed.
+            with self._timer('fetch'):
+                items = list(self._fetch_items(
+                    limit=None, place_holder=self._placeholder))
+            logging.debug('Items: {}'.format(len(items)))
+            for item in reversed(items):
+                yield item
+    
     def _iter_items(self):
-        items = list(self._fetch_items())
-        logging.debug('Items: {}'.format(len(items)))
-        items.sort(key=attrgetter('created_utc'))
-        return items
+        return _iter_reordered(self._iter_new_items(), REORDER_BUFFER_SIZE)
+    
+    def _get_processed_items(self, items):
+        """Return the shards of processed items ids, by bucket"""
+        buckets = sorted(set(_get_bucket(item) for item in items))
+        keys = [ndb.Key(ProcessedItems,
+                        '{}:{}'.format(self.PROCESSED_KEY, bucket))
+                for bucket in buckets]
+        
+        shards = {}
+        for bucket, key, shard in zip(buckets, keys, ndb.get_multi(keys)):
+            if shard is None:
+                shard = ProcessedItems(key=key, bucket=bucket, item_ids=[])
+            shards[bucket] = shard
+        return shards
+    
+    def _prefetch(self, processors):
+        """Fetch what the queuable processors will need, all at once"""
+        pass
     
-    @ndb.transactional
-    def _process_item(self, item):
-        processed_key = self.PROCESSED_KEY.format(item.id)
-        already_processed = utils.KVStore_exists(processed_key)
-        if not already_processed:
-            processor = self.PROCESSOR(item)
-            processor.run()
-        utils.KVStore_set(self.PLACEHOLDER_KEY, item.id)
-        utils.KVStore_set(self.PROCESSED_KEY.format(item.id))
+    def _iter_processors(self, items):
+        # By chunks, so that their lookups can be prefetched together
+        items = iter(items)
+        while True:
+            chunk = [(item, self.PROCESSOR(item))
+                     for item in itertools.islice(items, PREFETCH_CHUNK_SIZE)]
+            if not chunk:
+                return
+            
+            queuable = [processor for _, processor in chunk
+                        if processor._is_queuable]
+            with self._timer('prefetch'):
+                self._prefetch(queuable)
+            for pair in chunk:
+                yield pair
+    
+    def _iter_batches(self, items):
+        """Yield lists of (item, processor) pairs to process together
+        
+        Processors enqueue a task when their item is queuable, and there can
+        only be so many in a transaction.
+        """
+        batch_size = min(config.PROCESSING_BATCH_SIZE,
+                         MAX_PROCESSING_BATCH_SIZE)
+        batch = []
+        queuable_count = 0
+        for item, processor in self._iter_processors(items):
+            batch.append((item, processor))
+            if processor._is_queuable:
+                queuable_count += 1
+            
+            if (len(batch) == batch_size or
+                    queuable_count == MAX_TRANSACTIONAL_TASKS):
+                yield batch
+                batch = []
+                queuable_count = 0
+        
+        if batch:
+            yield batch
+    
+    @ndb.transactional(xg=True)
+    def _process_batch(self, batch):
+        shards = self._get_processed_items([item for item, _ in batch])
+        legacy_processed_ids = _get_legacy_processed_ids(
+            [item.id for item, _ in batch])
+        updated_buckets = set()
+        retention_cutoff = _get_retention_cutoff()
+        
+        for item, processor in batch:
+            bucket = _get_bucket(item)
+            if bucket < retention_cutoff:
+                # Whether it was processed has been forgotten, assume it was
+                logging.warning('Skipping expired item {}'.format(item.id))
+                outcome = 'expired'
+            elif item.id in legacy_processed_ids:
+                # Recorded anew, so that the legacy marker can be purged
+                if item.id not in shards[bucket]:
+                    shards[bucket].add(item.id)
+                    updated_buckets.add(bucket)
+                outcome = 'already_processed'
+            elif item.id not in shards[bucket]:
+                processor.run()
+                shards[bucket].add(item.id)
+                updated_buckets.add(bucket)
+                outcome = 'processed'
+            else:
+                outcome = 'already_processed'
+            metrics.increment_on_commit(metrics.ITEMS,
+                                        consumer=self.PROCESSED_KEY,
+                                        outcome=outcome)
+        
+        last_item, _ = batch[-1]
+        to_put = [shards[updated] for updated in updated_buckets]
+        to_put.append(KeyValueStore(id=self.PLACEHOLDER_KEY,
+                                    value=last_item.id))
+        ndb.put_multi(to_put)
+    
+    def _timer(self, stage):
+        return metrics.timer('{}.{}'.format(self.PROCESSED_KEY, stage))
     
     def run(self):
-        with self._lock:
+        with self._lock, self._timer('run'):
             self._placeholder = utils.KVStore_get(self.PLACEHOLDER_KEY)
+            if self._placeholder is None and self.LEGACY_PLACEHOLDER_KEY:
+                # Not migrated yet
+                self._placeholder = utils.KVStore_get(
+                    self.LEGACY_PLACEHOLDER_KEY, parent=_LEGACY_ANCESTOR)
             logging.debug('Placeholder: {}'.format(self._placeholder))
-            for item in self._iter_items():
-                self._process_item(item)
+            for batch in self._iter_batches(self._iter_items()):
+                with self._timer('process_batch'):
+                    self._process_batch(batch)
+
+
+# Time migrate_storage() finished at, as a timestamp
+MIGRATED_AT_KEY = 'storage_migrated_at'
+
+
+def _are_legacy_markers_expired():
+    """Return whether the retention period has passed since the migration
+    
+    Items listed since the deploy are recorded by the new scheme, so the
+    legacy markers are no longer needed by then.
+    """
+    migrated_at = utils.KVStore_get(MIGRATED_AT_KEY)
+    return (migrated_at is not None and
+            float(migrated_at) + config.PROCESSED_ITEMS_RETENTION <=
+            time.time())
+
+
+# Deferred
+def purge_processed_items():
+    """Delete the processed items markers past the retention period
+    
+    Also deletes the markers of the previous scheme, one KeyValueStore
+    entity per item, once they're past it as well.
+    """
+    logging.debug('Purging processed items')
+    
+    qry = ProcessedItems.query(ProcessedItems.bucket < _get_retention_cutoff())
+    keys = qry.fetch(PURGE_BATCH_SIZE, keys_only=True)
+    
+    if len(keys) < PURGE_BATCH_SIZE and _are_legacy_markers_expired():
+        start_key = ndb.Key(KeyValueStore, 'processed_comments:',
+                            parent=_LEGACY_ANCESTOR)
+        end_key = ndb.Key(KeyValueStore, 'processed_comments;',
+                          parent=_LEGACY_ANCESTOR)
+        qry = KeyValueStore.query(KeyValueStore.key >= start_key,
+                                  KeyValueStore.key < end_key,
+                                  ancestor=_LEGACY_ANCESTOR)
+        keys += qry.fetch(PURGE_BATCH_SIZE - len(keys), keys_only=True)
+    
+    ndb.delete_multi(keys)
+    if len(keys) == PURGE_BATCH_SIZE:
+        utils.defer(purge_processed_items)
 
 
 class CommentsConsumer(ItemsConsumer):
@@ -517,24 +1132,83 @@ class CommentsConsumer(ItemsConsumer):
     
     PROCESSOR = DeltaAdder
     PLACEHOLDER_KEY = 'comments'
-    PROCESSED_KEY = 'processed_comments:{}'
+    LEGACY_PLACEHOLDER_KEY = 'comments'
+    PROCESSED_KEY = 'comments'
+    FULLNAME_PREFIX = 't1_'
     
-    def _fetch_items(self):
+    def _fetch_items(self, **kwargs):
         r = utils.get_reddit()
-        return r.get_comments(config.SUBREDDIT, limit=None,
-                              place_holder=self._placeholder)
+        return r.get_comments(config.SUBREDDIT, **kwargs)
+    
+    def _prefetch(self, processors):
+        _prefetch_awardee_comments(processors)
 
 
 class MessagesConsumer(ItemsConsumer):
     _lock = threading.Lock()
     
     PROCESSOR = CommandMessageProcessor
-    PLACEHOLDER_KEY = 'comments'
-    PROCESSED_KEY = 'processed_comments:{}'
+    PLACEHOLDER_KEY = 'messages'
+    PROCESSED_KEY = 'messages'
+    FULLNAME_PREFIX = 't4_'
     
-    def _fetch_items(self):
+    def _fetch_items(self, **kwargs):
         r = utils.get_reddit()
-        messages = r.get_messages(limit=None, place_holder=self._placeholder)
+        messages = r.get_messages(**kwargs)
         for message in messages:
             del message.replies
             yield message
+
+
+MIGRATION_BATCH_SIZE = 100
+# The consumers' state first, so that they stop falling back on the legacy one
+MIGRATED_KINDS = ('KeyValueStore', 'ProcessedItems', 'Delta', 'UserStats',
+                  'PendingFlair')
+
+
+def _get_migrated_key(entity):
+    if isinstance(entity, Delta):
+        return utils.delta_key(entity.awarded_to, entity.awarder_comment_id)
+    else:
+        return ndb.Key(entity.key.kind(), entity.key.id())
+
+
+# Deferred
+def migrate_storage(kind_index=0, cursor=None):
+    """Move the entities out of the legacy entity group
+    
+    Entities are copied before the legacy ones are deleted, and the ones that
+    already exist at their new key are kept, so it can be run again safely.
+    The stats are rebuilt once everything is moved.
+    """
+    if kind_index == len(MIGRATED_KINDS):
+        if not utils.KVStore_exists(MIGRATED_AT_KEY):
+            utils.KVStore_set(MIGRATED_AT_KEY, str(time.time()))
+        utils.defer(rebuild_user_stats)
+        return
+    
+    kind = MIGRATED_KINDS[kind_index]
+    logging.debug('Migrating {} entities'.format(kind))
+    
+    qry = ndb.Query(kind=kind, ancestor=_LEGACY_ANCESTOR)
+    if cursor is not None:
+        cursor = Cursor(urlsafe=cursor)
+    entities, cursor, more = qry.fetch_page(MIGRATION_BATCH_SIZE,
+                                            start_cursor=cursor)
+    # Purged by purge_processed_items() instead
+    entities = [entity for entity in entities
+                if not str(entity.key.id()).startswith('processed_comments:')]
+    
+    new_keys = [_get_migrated_key(entity) for entity in entities]
+    to_put = []
+    for entity, new_key, existing in zip(entities, new_keys,
+                                         ndb.get_multi(new_keys)):
+        if existing is None:
+            to_put.append(type(entity)(key=new_key, **entity.to_dict()))
+    ndb.put_multi(to_put)
+    ndb.delete_multi([entity.key for entity in entities])
+    
+    if more:
+        utils.defer(migrate_storage, kind_index, cursor.urlsafe())
+    else:
+        utils.defer(migrate_storage, kind_index + 1)
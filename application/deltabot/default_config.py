@@ -0,0 +1,38 @@
+"""Settings that config.py may leave out, with their defaults
+
+They were added after config.py.example was first copied, so they're set
+here for existing config.py files to keep working.  Any of them can be
+overridden in config.py.
+"""
+
+from . import config
+
+# Flair and wiki updates for the same user or submission within this many
+# seconds are coalesced
+UPDATES_COALESCING_WINDOW = 60
+
+# How long the list of moderators is cached for, in seconds
+MODERATORS_CACHE_TTL = 600
+
+# How long the ids of processed comments and messages are kept for, in
+# seconds.  Older items are assumed to have been processed.
+PROCESSED_ITEMS_RETENTION = 7 * 24 * 3600
+
+# Number of comments or messages whose processing is checkpointed together.
+# Fewer means less to redo after a failure.  Capped at 24, because of the
+# limit of entity groups in a transaction.
+PROCESSING_BATCH_SIZE = 20
+
+# Requests left out of Reddit's rate limit, for other clients of the account
+REDDIT_RATELIMIT_RESERVE = 10
+
+# Most requests sent to Reddit at once when the quota allows it.  Should
+# match max_concurrent_requests of the reddit queue.
+REDDIT_BURST_SIZE = 10
+
+# Longest a task waits for Reddit's rate limit before being retried later,
+# in seconds
+REDDIT_MAX_WAIT = 10
+
+# Share compiled templates between instances through memcache
+TEMPLATES_BYTECODE_CACHE = not config.IS_DEV
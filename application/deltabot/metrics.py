@@ -0,0 +1,175 @@
+"""Counts and latency histograms of the bot's stages
+
+Measurements are buffered by thread, and added to counters in memcache once
+the outermost timed stage ends, typically a consumer run or a deferred task.
+Memcache may evict them, so they're meant to be scraped regularly rather
+than kept as totals.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+STAGE_SECONDS = 'deltabot_stage_seconds'
+STAGE_ERRORS = 'deltabot_stage_errors_total'
+CHECK_RESULTS = 'deltabot_check_results_total'
+ITEMS = 'deltabot_items_total'
+
+# Upper bounds, in seconds
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                     30, 60, float('inf'))
+
+_KEY_PREFIX = 'metrics:'
+_INDEX_KEY = 'metrics-index'
+_INDEX_UPDATE_ATTEMPTS = 5
+
+_local = threading.local()
+
+
+def _get_buffer():
+    if not hasattr(_local, 'buffer'):
+        _local.buffer = defaultdict(int)
+        _local.depth = 0
+    return _local.buffer
+
+
+def _format_bound(upper_bound):
+    return '+Inf' if upper_bound == float('inf') else repr(upper_bound)
+
+
+def _format_series(series):
+    name, labels = series
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(label, value)
+                                            for label, value in labels))
+
+
+def increment(name, value=1, **labels):
+    series = (name, tuple(sorted(labels.items())))
+    _get_buffer()[series] += value
+
+
+def increment_on_commit(name, value=1, **labels):
+    """Increment once the current transaction commits, if in one
+    
+    Failed attempts of the transaction aren't counted.
+    """
+    ndb.get_context().call_on_commit(
+        lambda: increment(name, value, **labels))
+
+
+def observe(stage, seconds):
+    for upper_bound in HISTOGRAM_BUCKETS:
+        if seconds <= upper_bound:
+            increment(STAGE_SECONDS + '_bucket', stage=stage,
+                      le=_format_bound(upper_bound))
+            break
+    increment(STAGE_SECONDS + '_count', stage=stage)
+    # Memcache counters are integers
+    increment(STAGE_SECONDS + '_sum', int(round(seconds * 1e6)),
+              stage=stage)
+
+
+@contextmanager
+def timer(stage):
+    """Time a stage, and count it as an error if it raises"""
+    _get_buffer()
+    _local.depth += 1
+    start = time.time()
+    try:
+        yield
+    except Exception:
+        increment(STAGE_ERRORS, stage=stage)
+        raise
+    finally:
+        observe(stage, time.time() - start)
+        _local.depth -= 1
+        if not _local.depth:
+            flush()
+
+
+def timed(stage):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _update_index(series):
+    client = memcache.Client()
+    for _ in range(_INDEX_UPDATE_ATTEMPTS):
+        index = client.gets(_INDEX_KEY)
+        if index is None:
+            if client.add(_INDEX_KEY, set(series)):
+                return
+        elif index.issuperset(series):
+            return
+        elif client.cas(_INDEX_KEY, index | set(series)):
+            return
+    logging.warning("Couldn't update the metrics index")
+
+
+def flush():
+    """Add the buffered measurements to the counters in memcache"""
+    buffer = _get_buffer()
+    if not buffer:
+        return
+    
+    measurements = dict(buffer)
+    buffer.clear()
+    try:
+        _update_index(measurements)
+        memcache.offset_multi(dict((_format_series(series), value)
+                                   for series, value in measurements.items()),
+                              key_prefix=_KEY_PREFIX, initial_value=0)
+    except Exception:
+        # Losing measurements is better than failing the task
+        logging.exception("Couldn't flush metrics")
+
+
+def _render_histogram(lines, series_values):
+    stages = sorted(set(dict(labels)['stage']
+                        for (name, labels) in series_values
+                        if name == STAGE_SECONDS + '_count'))
+    for stage in stages:
+        cumulative_count = 0
+        for upper_bound in HISTOGRAM_BUCKETS:
+            labels = (('le', _format_bound(upper_bound)), ('stage', stage))
+            series = (STAGE_SECONDS + '_bucket', labels)
+            cumulative_count += series_values.get(series, 0)
+            lines.append('{} {}'.format(_format_series(series),
+                                        cumulative_count))
+        
+        labels = (('stage', stage),)
+        sum_series = (STAGE_SECONDS + '_sum', labels)
+        count_series = (STAGE_SECONDS + '_count', labels)
+        lines.append('{} {}'.format(_format_series(sum_series),
+                                    series_values.get(sum_series, 0) / 1e6))
+        lines.append('{} {}'.format(_format_series(count_series),
+                                    series_values.get(count_series, 0)))
+
+
+def render_metrics():
+    """Return the counters in Prometheus' text format"""
+    index = sorted(memcache.get(_INDEX_KEY) or ())
+    values = memcache.get_multi([_format_series(series) for series in index],
+                                key_prefix=_KEY_PREFIX)
+    series_values = dict((series, int(values.get(_format_series(series), 0)))
+                         for series in index)
+    
+    lines = ['# TYPE {} histogram'.format(STAGE_SECONDS)]
+    _render_histogram(lines, series_values)
+    for name in (STAGE_ERRORS, CHECK_RESULTS, ITEMS):
+        lines.append('# TYPE {} counter'.format(name))
+        lines.extend('{} {}'.format(_format_series(series), value)
+                     for series, value in sorted(series_values.items())
+                     if series[0] == name)
+    return '\n'.join(lines) + '\n'
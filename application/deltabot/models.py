@@ -1,3 +1,5 @@
+from bisect import bisect_left, insort
+
 from google.appengine.ext import ndb
 
 
@@ -35,3 +37,59 @@ class KeyValueStore(ndb.Model):
     @classmethod
     def set(cls, key, value='', **kwargs):
         cls(id=key, value=value, **kwargs).put()
+
+
+class UserStats(ndb.Model):
+    """Counters of a user's non-removed deltas, keyed by username"""
+    
+    delta_count = ndb.IntegerProperty(default=0, indexed=False)
+    last_awarded_at = ndb.DateTimeProperty(indexed=False)
+    last_awarder_comment_url = ndb.StringProperty(indexed=False)
+    
+    @property
+    def username(self):
+        return self.key.id()
+    
+    def add_delta(self, delta):
+        self.delta_count += 1
+        if (self.last_awarded_at is None or
+                self.last_awarded_at <= delta.awarded_at):
+            self.last_awarded_at = delta.awarded_at
+            self.last_awarder_comment_url = delta.awarder_comment_url
+
+
+class UserHistory(ndb.Model):
+    """Rendered rows of a user's wiki page, keyed by username
+    
+    Rows are [delta id, awarded at timestamp, row] lists, latest first.  They
+    are all rendered again when the version, that of their format, changes.
+    """
+    
+    version = ndb.StringProperty(indexed=False, required=True)
+    rows = ndb.JsonProperty(compressed=True, required=True)
+
+
+class PendingFlair(ndb.Model):
+    """User flair waiting to be sent to Reddit, keyed by username"""
+    
+    queued_at = ndb.DateTimeProperty(auto_now=True, indexed=False)
+    attempts = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class ProcessedItems(ndb.Model):
+    """Ids of the items a consumer processed during a time bucket
+    
+    Keyed by '{consumer}:{bucket}'.  Reddit ids are base 36, so they're
+    stored as a sorted list of integers, which compresses well.
+    """
+    
+    bucket = ndb.IntegerProperty(required=True)
+    item_ids = ndb.JsonProperty(compressed=True, required=True)
+    
+    def __contains__(self, item_id):
+        item_id = int(item_id, 36)
+        i = bisect_left(self.item_ids, item_id)
+        return i < len(self.item_ids) and self.item_ids[i] == item_id
+    
+    def add(self, item_id):
+        insort(self.item_ids, int(item_id, 36))
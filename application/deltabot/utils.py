@@ -1,22 +1,25 @@
-from datetime import datetime, timedelta
-from functools import partial
+import hashlib
+import json
+import logging
+import math
 import os
 import re
+import threading
+import time
 
+from google.appengine.api import memcache, taskqueue
 from google.appengine.ext import deferred
 from google.appengine.ext import ndb
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, MemcachedBytecodeCache
 import praw
+from praw.handlers import DefaultHandler
 
 from . import config
-from .models import Delta, KeyValueStore
+from .models import Delta, KeyValueStore, UserStats
 
-_NDB_ANCESTOR = ndb.Key('_dummy', 1)
-
-
-KVStore_get = partial(KeyValueStore.get, parent=_NDB_ANCESTOR)
-KVStore_exists = partial(KeyValueStore.exists, parent=_NDB_ANCESTOR)
-KVStore_set = partial(KeyValueStore.set, parent=_NDB_ANCESTOR)
+KVStore_get = KeyValueStore.get
+KVStore_exists = KeyValueStore.exists
+KVStore_set = KeyValueStore.set
 
 
 def defer(callable, *args, **kwargs):
@@ -25,21 +28,69 @@ def defer(callable, *args, **kwargs):
     deferred.defer(callable, *args, **kwargs)
 
 
-defer_reddit = partial(defer, _queue='reddit')
+# Queue of each lane of calls to Reddit's API, and the share of the token
+# bucket it may use.  Lower lanes leave the rest for the higher ones.
+REDDIT_LANES = {
+    'interactive': ('reddit', 1.0),
+    'flair': ('reddit-flair', 0.5),
+    'bulk': ('reddit-bulk', 0.25),
+    'consumers': ('reddit-consumers', 1.0),
+}
+
+
+def defer_reddit(callable, *args, **kwargs):
+    """Defer a call to Reddit's API on the queue of its lane
+    
+    The lane is given by _lane, 'interactive' by default.  New tasks are
+    delayed while the quota is spent.
+    """
+    kwargs['_queue'] = REDDIT_LANES[kwargs.pop('_lane', 'interactive')][0]
+    if '_countdown' not in kwargs and '_eta' not in kwargs:
+        backoff = get_reddit_backoff()
+        if backoff:
+            kwargs['_countdown'] = int(math.ceil(backoff))
+    defer(callable, *args, **kwargs)
+
 
+def defer_coalesced(key, callable, *args, **kwargs):
+    """Defer a call to run at the end of the current time window
+    
+    Calls deferred with the same key during a window are coalesced into a
+    single task.  Since it relies on named tasks, which can't be
+    transactional, it must be called outside of transactions.
+    """
+    window = config.UPDATES_COALESCING_WINDOW
+    now = time.time()
+    bucket = int(now // window)
+    kwargs['_name'] = '{}-{}'.format(key, bucket)
+    kwargs['_countdown'] = int(math.ceil((bucket + 1) * window - now))
+    try:
+        defer(callable, *args, **kwargs)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
 
-def ndb_query(model, *args, **kwargs):
-    kwargs['ancestor'] = _NDB_ANCESTOR
-    return model.query(*args, **kwargs)
 
+def defer_reddit_coalesced(key, callable, *args, **kwargs):
+    kwargs['_queue'] = REDDIT_LANES[kwargs.pop('_lane', 'interactive')][0]
+    defer_coalesced(key, callable, *args, **kwargs)
 
-def ndb_model(model, *args, **kwargs):
-    kwargs['parent'] = _NDB_ANCESTOR
-    return model(*args, **kwargs)
+
+def user_key(username):
+    """Return the key of the entity group of a user's deltas
+    
+    It's also the key of the user's stats, so that they can be updated in the
+    same transaction as the deltas.
+    """
+    return ndb.Key(UserStats, username)
+
+
+def delta_key(awardee_username, awarder_comment_id):
+    return ndb.Key(Delta, awarder_comment_id,
+                   parent=user_key(awardee_username))
 
 
 def query_delta(*args, **kwargs):
-    qry = ndb_query(Delta)
+    qry = Delta.query(ancestor=kwargs.get('ancestor'))
     if not kwargs['include_removed']:
         qry = qry.filter(Delta.status != 'removed_abuse',
                          Delta.status != 'removed_low_effort',
@@ -47,54 +98,523 @@ def query_delta(*args, **kwargs):
     return qry.filter(*args)
 
 
-@ndb.transactional
-def get_reddit():
-    dt_format = '%Y-%m-%d %H:%I:%S'
-    now = datetime.utcnow()
-    
-    def refresh_access_info():
-        refresh_token = config.OAUTH_REFRESH_TOKEN
-        new_access_info = r.refresh_access_information(refresh_token)
-        KVStore_set('access_info', str(new_access_info))
-        KVStore_set('access_info_last_refresh', now.strftime(dt_format))
-    
-    r = praw.Reddit(config.USER_AGENT, config.REDDIT_SITE)
-    
-    access_info_last_refresh_str = KVStore_get('access_info_last_refresh')
-    if access_info_last_refresh_str:
-        access_info_last_refresh = datetime.strptime(
-            access_info_last_refresh_str, dt_format)
-        if now - access_info_last_refresh <= timedelta(hours=1):
-            access_info_str = KVStore_get('access_info')
-            access_info = eval(access_info_str)
-            r.set_access_credentials(**access_info)
+# Access tokens are valid for an hour
+_ACCESS_INFO_TTL = 55 * 60
+_ACCESS_INFO_REFRESH_LOCK_KEY = 'access_info_refresh_lock'
+_ACCESS_INFO_REFRESH_LOCK_TIMEOUT = 30
+_ACCESS_INFO_REFRESH_WAIT = 10
+
+# PRAW clients aren't thread-safe, so each thread gets its own, but they all
+# share the instance's access token
+_reddit_local = threading.local()
+_access_info = None
+# Reentrant since a 401 from the OAuth endpoint invalidates the token
+_access_info_lock = threading.RLock()
+
+
+_RATELIMIT_KEY = 'reddit_ratelimit'
+_TOKEN_BUCKET_KEY = 'reddit_token_bucket'
+_TOKEN_BUCKET_UPDATE_ATTEMPTS = 10
+# Until Reddit tells how much of the quota is left
+_DEFAULT_REDDIT_RATE = 1.0
+
+
+def _store_ratelimit(response):
+    remaining = response.headers.get('X-Ratelimit-Remaining')
+    reset = response.headers.get('X-Ratelimit-Reset')
+    if remaining is None or reset is None:
+        return
+    ratelimit = {
+        'remaining': float(remaining),
+        'reset_at': time.time() + float(reset),
+    }
+    memcache.set(_RATELIMIT_KEY, ratelimit)
+
+
+def _get_reddit_quota():
+    """Return the requests per second and burst size allowed until reset
+    
+    Also returns when the quota resets, if it's spent.
+    """
+    ratelimit = memcache.get(_RATELIMIT_KEY)
+    now = time.time()
+    if ratelimit is None or ratelimit['reset_at'] <= now:
+        return _DEFAULT_REDDIT_RATE, 1, None
+    
+    available = ratelimit['remaining'] - config.REDDIT_RATELIMIT_RESERVE
+    if available < 1:
+        return 0, 0, ratelimit['reset_at']
+    # Spread what's left evenly until the reset, bursts included
+    rate = available / (ratelimit['reset_at'] - now)
+    burst = min(config.REDDIT_BURST_SIZE, int(available))
+    return rate, burst, None
+
+
+def get_reddit_backoff():
+    """Return how long to wait for Reddit's quota to reset, if it's spent"""
+    _, _, reset_at = _get_reddit_quota()
+    return max(reset_at - time.time(), 0) if reset_at else 0
+
+
+def _get_lane_share():
+    # Tasks know their queue.  Requests made outside of the lanes, by request
+    # handlers or scripts, get the whole bucket.
+    queue_name = os.environ.get('HTTP_X_APPENGINE_QUEUENAME')
+    for lane_queue_name, share in REDDIT_LANES.values():
+        if lane_queue_name == queue_name:
+            return share
+    return 1.0
+
+
+class RedditRateLimited(praw.errors.RateLimitExceeded):
+    """Raised instead of waiting longer than REDDIT_MAX_WAIT for the quota
+    
+    Deferred tasks that raise it are retried later.
+    """
+    
+    def __init__(self, sleep_time):
+        super(RedditRateLimited, self).__init__(
+            self.ERROR_TYPE, "Reddit's rate limit reached", '',
+            {'ratelimit': sleep_time})
+
+
+def _acquire_reddit_token():
+    """Wait for the token bucket shared by all instances to allow a request
+    
+    Raises RedditRateLimited if that would take longer than REDDIT_MAX_WAIT.
+    """
+    client = memcache.Client()
+    share = _get_lane_share()
+    deadline = time.time() + config.REDDIT_MAX_WAIT
+    attempts = 0
+    while attempts < _TOKEN_BUCKET_UPDATE_ATTEMPTS:
+        rate, burst, reset_at = _get_reddit_quota()
+        now = time.time()
+        if reset_at:
+            wait = reset_at - now
         else:
-            refresh_access_info()
-    else:
-        refresh_access_info()
+            bucket = client.gets(_TOKEN_BUCKET_KEY)
+            if bucket is None:
+                tokens = burst
+            else:
+                tokens, updated_at = bucket
+                tokens = min(tokens + (now - updated_at) * rate, burst)
+            # Tokens the lane has to leave in the bucket
+            floor = (burst - 1) * (1 - share)
+            
+            if tokens >= floor + 1:
+                bucket_update = (tokens - 1, now)
+                if bucket is None:
+                    stored = client.add(_TOKEN_BUCKET_KEY, bucket_update)
+                else:
+                    stored = client.cas(_TOKEN_BUCKET_KEY, bucket_update)
+                if stored:
+                    return
+                # Another request took a token meanwhile
+                attempts += 1
+                continue
+            wait = (floor + 1 - tokens) / rate
+        
+        if now + wait > deadline:
+            raise RedditRateLimited(wait)
+        # The quota may have reset since it was read
+        time.sleep(max(wait, 0))
+    
+    # Better send the request than stall on memcache contention or failures
+    logging.warning("Couldn't take a token from the Reddit token bucket")
+
+
+class RedditHandler(DefaultHandler):
+    def request(self, request, proxies, timeout, **_):
+        """Send a request to Reddit, once the token bucket allows it
+        
+        Only called for the requests PRAW's cache can't answer.  The token
+        bucket replaces PRAW's delay between requests, which only applies to
+        the instance.
+        """
+        _acquire_reddit_token()
+        response = self.http.send(request, proxies=proxies, timeout=timeout,
+                                  allow_redirects=False)
+        _store_ratelimit(response)
+        if response.status_code == 401:
+            # The token got revoked or expired earlier than expected
+            invalidate_access_info()
+        return response
+RedditHandler.request = DefaultHandler.with_cache(RedditHandler.request)
+
+
+def _is_fresh(access_info):
+    return bool(access_info) and access_info['expires_at'] > time.time()
+
+
+def _load_access_info():
+    access_info_json = KVStore_get('access_info')
+    try:
+        return json.loads(access_info_json)
+    except (TypeError, ValueError):  # not stored yet, or in the old format
+        return None
+
+
+def _refresh_access_info(r):
+    if not memcache.add(_ACCESS_INFO_REFRESH_LOCK_KEY, 1,
+                        time=_ACCESS_INFO_REFRESH_LOCK_TIMEOUT):
+        # Another instance is refreshing the token, wait for it to store it
+        # instead of hitting the OAuth endpoint as well
+        for _ in range(_ACCESS_INFO_REFRESH_WAIT):
+            time.sleep(1)
+            access_info = _load_access_info()
+            if _is_fresh(access_info):
+                return access_info
+    
+    try:
+        new_access_info = r.refresh_access_information(
+            config.OAUTH_REFRESH_TOKEN, update_session=False)
+        access_info = {
+            'access_token': new_access_info['access_token'],
+            'refresh_token': new_access_info['refresh_token'],
+            'scope': sorted(new_access_info['scope']),
+            'expires_at': time.time() + _ACCESS_INFO_TTL,
+        }
+        KVStore_set('access_info', json.dumps(access_info))
+    finally:
+        memcache.delete(_ACCESS_INFO_REFRESH_LOCK_KEY)
+    
+    return access_info
+
+
+@ndb.non_transactional
+def _get_access_info(r):
+    global _access_info
+    
+    with _access_info_lock:
+        if not _is_fresh(_access_info):
+            access_info = _load_access_info()
+            if not _is_fresh(access_info):
+                access_info = _refresh_access_info(r)
+            _access_info = access_info
+        return _access_info
+
+
+def get_reddit():
+    r = getattr(_reddit_local, 'reddit', None)
+    if r is None:
+        r = praw.Reddit(config.USER_AGENT, config.REDDIT_SITE,
+                        handler=RedditHandler())
+        _reddit_local.reddit = r
+    
+    access_info = _get_access_info(r)
+    access_token = access_info['access_token']
+    if getattr(_reddit_local, 'access_token', None) != access_token:
+        r.set_access_credentials(set(access_info['scope']), access_token,
+                                 access_info['refresh_token'],
+                                 update_user=False)
+        _reddit_local.access_token = access_token
     
     return r
 
 
+@ndb.transactional
+def _expire_stored_access_info(access_token):
+    access_info = _load_access_info()
+    if access_info and access_info['access_token'] == access_token:
+        access_info['expires_at'] = 0
+        KVStore_set('access_info', json.dumps(access_info))
+
+
+@ndb.non_transactional
+def invalidate_access_info():
+    """Force the access token to be refreshed, on every instance"""
+    global _access_info
+    
+    with _access_info_lock:
+        if _access_info:
+            # Unless another instance already replaced it
+            _expire_stored_access_info(_access_info['access_token'])
+        _access_info = None
+
+
+def clear_reddit_cache():
+    """Forget the instance's access token and the current thread's client"""
+    global _access_info
+    
+    with _access_info_lock:
+        _access_info = None
+    _reddit_local.__dict__.clear()
+
+
+_moderators = {}
+# Instances check memcache this often, so that invalidations reach them
+_MODERATORS_INSTANCE_TTL = 60
+
+
+def get_moderator_usernames(subreddit):
+    """Return the usernames of the subreddit's moderators
+    
+    The list is cached in memcache for MODERATORS_CACHE_TTL seconds, and by
+    each instance for up to _MODERATORS_INSTANCE_TTL of them.
+    """
+    now = time.time()
+    cached = _moderators.get(subreddit)
+    
+    if not cached or cached[0] <= now:
+        cache_key = 'moderators:{}'.format(subreddit)
+        cached = memcache.get(cache_key)
+        if not cached or cached[0] <= now:
+            r = get_reddit()
+            moderators = r.get_moderators(subreddit)
+            usernames = frozenset(moderator.name for moderator in moderators)
+            ttl = config.MODERATORS_CACHE_TTL
+            cached = (now + ttl, usernames)
+            memcache.set(cache_key, cached, time=ttl)
+        _moderators[subreddit] = (
+            min(cached[0], now + _MODERATORS_INSTANCE_TTL), cached[1])
+    
+    return cached[1]
+
+
+def invalidate_moderators_cache(subreddit):
+    """Refetch the moderators on the next check, once the team changed
+    
+    Other instances keep their copy for up to _MODERATORS_INSTANCE_TTL
+    seconds.
+    """
+    _moderators.pop(subreddit, None)
+    memcache.delete('moderators:{}'.format(subreddit))
+
+
+# Reddit's limit
+_INFO_BATCH_SIZE = 100
+
+
+def get_things(fullnames):
+    """Return a dict of the things with the given fullnames, by fullname
+    
+    Fetched with as few requests as possible.  Things that weren't found
+    are missing from the dict.
+    """
+    fullnames = sorted(set(fullnames))
+    things = {}
+    if not fullnames:
+        return things
+    
+    r = get_reddit()
+    for i in range(0, len(fullnames), _INFO_BATCH_SIZE):
+        batch = fullnames[i:i + _INFO_BATCH_SIZE]
+        for thing in r.get_info(thing_id=batch) or []:
+            things[thing.fullname] = thing
+    return things
+
+
+def _get_fingerprint_key(target):
+    return ndb.Key(KeyValueStore, 'fingerprint:' + target)
+
+
+def _get_fingerprint(content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def get_changed_targets(contents):
+    """Return the targets whose content differs from the last one written
+    
+    Takes a dict of contents by target, like 'wiki:user/john'.
+    """
+    targets = list(contents)
+    fingerprints = ndb.get_multi([_get_fingerprint_key(target)
+                                  for target in targets])
+    return set(target for target, fingerprint in zip(targets, fingerprints)
+               if (fingerprint is None or
+                   fingerprint.value != _get_fingerprint(contents[target])))
+
+
+def set_written(contents):
+    """Remember the contents written to Reddit, by target"""
+    ndb.put_multi([KeyValueStore(key=_get_fingerprint_key(target),
+                                 value=_get_fingerprint(content))
+                   for target, content in contents.items()])
+
+
+def _pluralize(count_or_seq, singular, plural):
+    try:
+        count = len(count_or_seq)
+    except TypeError:
+        count = count_or_seq
+    return singular if count == 1 else plural
+
+
+_jinja_env = None
+
+
+def _get_jinja_env():
+    global _jinja_env
+    
+    if _jinja_env is None:
+        # Templates never change on a deployed instance, so skip the mtime
+        # checks outside the dev server.  Compiled templates are kept in the
+        # environment's cache for the lifetime of the instance.
+        templates_dir = os.path.join(os.path.dirname(__file__), 'templates')
+        bytecode_cache = None
+        if config.TEMPLATES_BYTECODE_CACHE:
+            # There's no writable filesystem, so cold instances share the
+            # compiled bytecode through memcache
+            bytecode_cache = MemcachedBytecodeCache(memcache)
+        jinja_env = Environment(loader=FileSystemLoader(templates_dir),
+                                bytecode_cache=bytecode_cache,
+                                auto_reload=config.IS_DEV,
+                                trim_blocks=True, lstrip_blocks=True,
+                                keep_trailing_newline=True)
+        jinja_env.globals['pluralize'] = _pluralize
+        jinja_env.globals['config'] = config
+        _jinja_env = jinja_env
+    
+    return _jinja_env
+
+
 def render_template(filename, **vars):
-    def pluralize(count_or_seq, singular, plural):
-        try:
-            count = len(count_or_seq)
-        except TypeError:
-            count = count_or_seq
-        return singular if count == 1 else plural
-    
-    templates_dir = os.path.join(os.path.dirname(__file__), 'templates')
-    jinja_env = Environment(loader=FileSystemLoader(templates_dir),
-                            trim_blocks=True, lstrip_blocks=True,
-                            keep_trailing_newline=True)
-    jinja_env.globals['pluralize'] = pluralize
-    jinja_env.globals['config'] = config
-    
-    template = jinja_env.get_template(filename)
+    template = _get_jinja_env().get_template(filename)
     return template.render(**vars)
 
 
+def get_template_fingerprint(filename):
+    """Return a fingerprint of a template's source, to detect changes"""
+    jinja_env = _get_jinja_env()
+    source, _, _ = jinja_env.loader.get_source(jinja_env, filename)
+    return _get_fingerprint(source)
+
+
+_rendered_templates = {}
+
+
+def render_template_cached(filename, **vars):
+    """Like render_template(), but only renders once per set of variables
+    
+    Only meant for templates whose variables take a handful of values, like
+    the fixed reply to each error.
+    """
+    cache_key = (filename, frozenset(vars.items()))
+    if cache_key not in _rendered_templates:
+        _rendered_templates[cache_key] = render_template(filename, **vars)
+    return _rendered_templates[cache_key]
+
+
+def preload_templates():
+    jinja_env = _get_jinja_env()
+    for filename in jinja_env.list_templates():
+        jinja_env.get_template(filename)
+
+
+_RE_NON_BLANK = re.compile(r'[^\x20\t]')
+
+_token_patterns = {}
+
+
+def _get_token_pattern(tokens):
+    pattern = _token_patterns.get(tokens)
+    if pattern is None:
+        # Longest first, in case a token contains another one
+        sorted_tokens = sorted(tokens, key=len, reverse=True)
+        pattern = re.compile('|'.join(re.escape(token)
+                                      for token in sorted_tokens))
+        _token_patterns[tokens] = pattern
+    return pattern
+
+
+def _indent_width(text, start, end):
+    if end - start >= 4:
+        return 4
+    width = 0
+    for char in text[start:end]:
+        # Tabs are expanded to the next multiple of 4
+        width += 1 if char == ' ' else 4 - width % 4
+    return width
+
+
+def _paragraph_has_token(text, start, end, token_pattern):
+    pos = start
+    while True:
+        tick = text.find('`', pos, end)
+        if tick == -1:
+            return bool(token_pattern.search(text, pos, end))
+        elif token_pattern.search(text, pos, tick):
+            return True
+        
+        closing_tick = text.find('`', tick + 1, end)
+        if closing_tick == -1:
+            # Unmatched backtick, the rest of the paragraph isn't code
+            return bool(token_pattern.search(text, tick + 1, end))
+        elif closing_tick == tick + 1:
+            # An empty code span isn't one, but the second backtick may open
+            # another span
+            pos = tick + 1
+        else:
+            pos = closing_tick + 1
+
+
+def has_unquoted_token(text, tokens):
+    """Return whether a token appears in Markdown text out of code and quotes
+    
+    Ignores code blocks, block quotes and inline code.  Scans the text in a
+    single pass without copying it, so it's linear in the length of the text
+    whatever its content.
+    """
+    token_pattern = _get_token_pattern(tuple(tokens))
+    if not token_pattern.search(text):
+        # Most comments don't contain any token at all
+        return False
+    
+    in_code_block = in_block_quote = False
+    paragraph_start = None
+    previous_blank = True
+    pos = 0
+    
+    while pos <= len(text):
+        end = text.find('\n', pos)
+        if end == -1:
+            end = len(text)
+        
+        first_char = _RE_NON_BLANK.search(text, pos, end)
+        is_blank = first_char is None
+        if is_blank:
+            indent = 0
+        else:
+            indent = _indent_width(text, pos, first_char.start())
+        
+        if in_code_block and (is_blank or indent >= 4):
+            pass
+        elif in_block_quote and not is_blank:
+            # Lazy continuation
+            pass
+        else:
+            in_code_block = in_block_quote = False
+            
+            if is_blank:
+                is_text = False
+            elif indent >= 4 and previous_blank:
+                in_code_block = True
+                is_text = False
+            elif indent < 4 and first_char.group() == '>':
+                in_block_quote = True
+                is_text = False
+            else:
+                is_text = True
+            
+            if is_text and paragraph_start is None:
+                paragraph_start = pos
+            elif not is_text and paragraph_start is not None:
+                if _paragraph_has_token(text, paragraph_start, pos - 1,
+                                        token_pattern):
+                    return True
+                paragraph_start = None
+        
+        previous_blank = is_blank
+        pos = end + 1
+    
+    return (paragraph_start is not None and
+            _paragraph_has_token(text, paragraph_start, len(text),
+                                 token_pattern))
+
+
 _RE_FULLNAME_PREFIX = re.compile(r'^t[1-5]_')
 
 
@@ -0,0 +1,20 @@
+"""Handler of the deferred tasks
+
+The deferred library's, except that the tasks stopped by Reddit's rate limit
+are retried later like any other singular failure.
+"""
+
+from google.appengine.ext import deferred, webapp
+
+from .deltabot.utils import RedditRateLimited
+
+
+class DeferredTaskHandler(deferred.TaskHandler):
+    def run_from_request(self):
+        try:
+            super(DeferredTaskHandler, self).run_from_request()
+        except RedditRateLimited as e:
+            raise deferred.SingularTaskFailure(str(e))
+
+
+app = webapp.WSGIApplication([('.*', DeferredTaskHandler)])
@@ -1,9 +1,13 @@
+from flask import Response
 from google.appengine.api.taskqueue import TaskRetryOptions
 
 from . import app
-from .deltabot import config
-from .deltabot.bot import CommentsConsumer, MessagesConsumer
-from .deltabot.utils import defer_reddit
+from .deltabot import config, metrics
+from .deltabot.bot import (CommentsConsumer, MessagesConsumer,
+                           migrate_storage, purge_processed_items,
+                           rebuild_user_stats)
+from .deltabot.utils import (defer, defer_reddit,
+                             invalidate_moderators_cache, preload_templates)
 
 cron_retry_options = TaskRetryOptions(task_retry_limit=0)
 
@@ -16,7 +20,8 @@ def index():
 @app.route('/crons/consumecomments')
 def consume_comments():
     comments_consumer = CommentsConsumer()
-    defer_reddit(comments_consumer.run, _retry_options=cron_retry_options)
+    defer_reddit(comments_consumer.run, _lane='consumers',
+                 _retry_options=cron_retry_options)
     return 'Task enqueued'
 
 
@@ -24,11 +29,42 @@ def consume_comments():
 def consume_messages():
     messages_consumer = MessagesConsumer()
     countdown = 0 if config.IS_DEV else 600
-    defer_reddit(messages_consumer.run, _countdown=countdown,
-                 _retry_options=cron_retry_options)
+    defer_reddit(messages_consumer.run, _lane='consumers',
+                 _countdown=countdown, _retry_options=cron_retry_options)
+    return 'Task enqueued'
+
+
+@app.route('/crons/rebuilduserstats')
+def rebuild_stats():
+    defer(rebuild_user_stats)
+    return 'Task enqueued'
+
+
+@app.route('/crons/purgeprocesseditems')
+def purge_processed():
+    defer(purge_processed_items)
     return 'Task enqueued'
 
 
+@app.route('/admin/migratestorage')
+def migrate():
+    defer(migrate_storage)
+    return 'Task enqueued'
+
+
+@app.route('/admin/refreshmoderators')
+def refresh_moderators():
+    invalidate_moderators_cache(config.SUBREDDIT)
+    return 'Moderators cache invalidated'
+
+
+@app.route('/admin/metrics')
+def show_metrics():
+    return Response(metrics.render_metrics(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route('/_ah/warmup')
 def warmup():
+    preload_templates()
     return ''
@@ -0,0 +1,144 @@
+"""Benchmarks of the bot's hot functions, and of the importer's parser
+
+Each benchmark takes one of its parameters, sets up its data, and returns
+the function to time.
+"""
+
+from collections import namedtuple
+import random
+import warnings
+
+from google.appengine.ext import ndb
+
+from application.deltabot import bot, config, utils
+from benchmarks import data
+from scripts import cmv_wiki
+
+Benchmark = namedtuple('Benchmark', 'name function params')
+
+BENCHMARKS = []
+
+RENDER_SIZES = (10, 1000, 50000)
+DATASTORE_SIZES = (10, 1000, 10000)
+
+
+def benchmark(name, params):
+    """Register a benchmark, run once per parameter with fresh stubs"""
+    def decorator(function):
+        BENCHMARKS.append(Benchmark(name, function, params))
+        return function
+    return decorator
+
+
+def _rng():
+    return random.Random(42)
+
+
+def _get_has_delta_token_body(kind):
+    rng = _rng()
+    token = config.DELTA
+    return {
+        'typical': lambda: data.comment_body(rng, token),
+        'no-token': lambda: data.comment_body(rng, 'no delta'),
+        'long': lambda: data.long_comment_body(rng, token),
+        'quoted': lambda: data.quoted_tokens_body(token),
+        'code-block': lambda: data.code_block_tokens_body(token),
+        'inline-code': lambda: data.inline_code_tokens_body(token),
+        'unmatched-ticks': lambda: data.unmatched_ticks_body() + token,
+    }[kind]()
+
+
+@benchmark('DeltaAdder._has_delta_token',
+           ('typical', 'no-token', 'long', 'quoted', 'code-block',
+            'inline-code', 'unmatched-ticks'))
+def has_delta_token(kind):
+    comment = data.FakeComment('00000c', _get_has_delta_token_body(kind))
+    return bot.DeltaAdder(comment)._has_delta_token
+
+
+@benchmark('has_unquoted_token',
+           ('long', 'quoted', 'code-block', 'unmatched-ticks'))
+def has_unquoted_token(kind):
+    # The scanner alone, on the bodies that were quadratic before it
+    text = _get_has_delta_token_body(kind)
+    tokens = (config.DELTA,) + config.DELTA_ALIASES
+    return lambda: utils.has_unquoted_token(text, tokens)
+
+
+@benchmark('render_template wiki/user_history.md', RENDER_SIZES)
+def render_user_history(size):
+    rows = [bot._render_user_history_row(delta)[2]
+            for delta in data.deltas(_rng(), size, 'awardee')]
+    utils.render_template('wiki/user_history.md', username='awardee',
+                          rows=rows)  # compile the template
+    return lambda: utils.render_template('wiki/user_history.md',
+                                         username='awardee', rows=rows)
+
+
+@benchmark('render_template wiki/tracker.md', RENDER_SIZES)
+def render_tracker(size):
+    users = data.user_stats(_rng(), size)
+    utils.render_template('wiki/tracker.md', shard='a', users=users)
+    return lambda: utils.render_template('wiki/tracker.md', shard='a',
+                                         users=users)
+
+
+@benchmark('_get_user_history_rows', DATASTORE_SIZES)
+def get_user_history_rows(size):
+    ndb.put_multi(data.deltas(_rng(), size, 'awardee'))
+    bot._get_user_history_rows('awardee')  # cache the rows
+    return lambda: bot._get_user_history_rows('awardee')
+
+
+@benchmark('_get_tracker_users', DATASTORE_SIZES)
+def get_tracker_users(size):
+    ndb.put_multi(data.user_stats(_rng(), size))
+    return bot._get_tracker_users
+
+
+@benchmark('_get_tracker_users shard', DATASTORE_SIZES)
+def get_tracker_shard_users(size):
+    ndb.put_multi(data.user_stats(_rng(), size))
+    return lambda: bot._get_tracker_users('a')
+
+
+@benchmark('fullname_to_id', ('t1_', 'none'))
+def fullname_to_id(prefix):
+    fullname = ('' if prefix == 'none' else prefix) + 'c0ffee'
+    return lambda: utils.fullname_to_id(fullname)
+
+
+@benchmark('get_comment_url', ('no-context', 'context'))
+def get_comment_url(kind):
+    comment = data.FakeComment('c0ffee', '')
+    context = 2 if kind == 'context' else None
+    return lambda: utils.get_comment_url(comment, context)
+
+
+def _search_no_thread(submission_url, username):
+    return []
+
+
+def _get_legacy_page(kind):
+    rng = _rng()
+    return {
+        'v3-100': lambda: data.wiki_page_v3(rng, 100),
+        'v3-2000': lambda: data.wiki_page_v3(rng, 2000),
+        'v3+v2-1000': lambda: data.wiki_page_v3(rng, 1000, v2_count=1000),
+        'v2-1000': lambda: data.wiki_page_v2(rng, 1000),
+        'v1-1000': lambda: data.wiki_page_v1(rng, 1000),
+    }[kind]()
+
+
+@benchmark('cmv_wiki.parse_user_page',
+           ('v3-100', 'v3-2000', 'v3+v2-1000', 'v2-1000', 'v1-1000'))
+def parse_user_page(kind):
+    page = _get_legacy_page(kind)
+    
+    def parse():
+        # Threads aren't searched, hence warnings about the missing deltas
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return list(cmv_wiki.parse_user_page(page, 'awardee',
+                                                 _search_no_thread))
+    return parse
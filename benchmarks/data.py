@@ -0,0 +1,198 @@
+"""Generators of synthetic data for the benchmarks
+
+They take a random.Random instance, so that a given seed always generates
+the same data.
+"""
+
+from datetime import datetime, timedelta
+import string
+
+from application.deltabot import utils
+from application.deltabot.models import Delta, UserStats
+
+# Reddit's limit
+MAX_COMMENT_LENGTH = 10000
+
+_CMV_URL = 'http://www.reddit.com/r/changemyview/comments/{}/{}/'
+
+_EPOCH = datetime(2013, 1, 1)
+
+
+class FakeComment(object):
+    def __init__(self, id, body, link_id='t3_00000a', parent_id='t1_00000b',
+                 author_name='awarder'):
+        self.id = id
+        self.body = body
+        self.link_id = link_id
+        self.parent_id = parent_id
+        self.author = FakeRedditor(author_name)
+
+
+class FakeRedditor(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def random_id(rng):
+    return ''.join(rng.choice(string.digits + string.ascii_lowercase)
+                   for _ in range(6))
+
+
+def random_username(rng):
+    length = rng.randint(3, 20)
+    return ''.join(rng.choice(string.ascii_letters + string.digits + '_-')
+                   for _ in range(length))
+
+
+def _sentence(rng):
+    words = [''.join(rng.choice(string.ascii_lowercase)
+                     for _ in range(rng.randint(1, 9)))
+             for _ in range(rng.randint(5, 25))]
+    return ' '.join(words).capitalize() + '.'
+
+
+def _paragraph(rng):
+    return ' '.join(_sentence(rng) for _ in range(rng.randint(1, 6)))
+
+
+def comment_body(rng, token, paragraphs=3):
+    """A comment awarding a delta, quoting the parent and with some code"""
+    blocks = ['> ' + _paragraph(rng)]
+    for _ in range(paragraphs):
+        block = _paragraph(rng)
+        if rng.random() < 0.3:
+            block += ' Like `{}` says.'.format(random_id(rng))
+        blocks.append(block)
+    blocks.append(u'{} {}'.format(token, _sentence(rng)))
+    return u'\n\n'.join(blocks)
+
+
+def long_comment_body(rng, token):
+    """A comment of the maximum length with the token at the very end"""
+    body = u''
+    while len(body) < MAX_COMMENT_LENGTH - 200:
+        body += _paragraph(rng) + u'\n\n'
+    return body + token
+
+
+def quoted_tokens_body(token):
+    """Quoted lines only, all of them containing the token"""
+    line = u'> {} quoted\n'.format(token)
+    return line * (MAX_COMMENT_LENGTH // len(line))
+
+
+def code_block_tokens_body(token):
+    """An indented code block only, all of its lines containing the token"""
+    line = u'    {} = 1\n'.format(token)
+    return u'\n' + line * (MAX_COMMENT_LENGTH // len(line))
+
+
+def inline_code_tokens_body(token):
+    """One paragraph of inline code spans, all of them containing the token"""
+    span = u'`{}` '.format(token)
+    return span * (MAX_COMMENT_LENGTH // len(span))
+
+
+def unmatched_ticks_body():
+    """Many short paragraphs of unmatched backticks, without any token"""
+    line = u'` a\n\n'
+    return line * (MAX_COMMENT_LENGTH // len(line))
+
+
+def deltas(rng, count, awardee_username):
+    """Deltas awarded to the same user, over a few years"""
+    deltas = []
+    for i in range(count):
+        awarder_comment_id = '{:x}'.format(i)
+        submission_id = random_id(rng)
+        deltas.append(Delta(
+            key=utils.delta_key(awardee_username, awarder_comment_id),
+            awarded_at=_EPOCH + timedelta(seconds=rng.randint(0, 10 ** 8)),
+            awarded_by=random_username(rng),
+            awarded_to=awardee_username,
+            awarder_comment_id=awarder_comment_id,
+            awarder_comment_url='https://www.reddit.com/r/sub/comments/'
+                                '{}/_/{}'.format(submission_id,
+                                                 awarder_comment_id),
+            submission_id=submission_id,
+            submission_title=_sentence(rng)[:300],
+            submission_url='https://www.reddit.com/r/sub/comments/'
+                           '{}/_/'.format(submission_id),
+        ))
+    return deltas
+
+
+def user_stats(rng, count):
+    """Stats of distinct users having earned at least a delta"""
+    usernames = set()
+    while len(usernames) < count:
+        usernames.add(random_username(rng))
+    return [UserStats(
+        id=username,
+        delta_count=rng.randint(1, 100),
+        last_awarded_at=_EPOCH + timedelta(seconds=rng.randint(0, 10 ** 8)),
+        last_awarder_comment_url='https://www.reddit.com/r/sub/comments/'
+                                 '{}/_/{}'.format(random_id(rng),
+                                                  random_id(rng)),
+    ) for username in sorted(usernames)]
+
+
+def _cmv_username(rng):
+    # The legacy pages only have usernames matching \w+
+    return ''.join(rng.choice(string.ascii_letters + string.digits + '_')
+                   for _ in range(rng.randint(3, 20)))
+
+
+def _cmv_date(rng):
+    date = _EPOCH + timedelta(seconds=rng.randint(0, 10 ** 8))
+    return '{d.month}/{d.day}/{d.year}'.format(d=date)
+
+
+def _cmv_submission(rng):
+    title = _sentence(rng)[:300]
+    slug = '_'.join(title.lower().split()[:8]).strip('.')
+    return title, _CMV_URL.format(random_id(rng), slug)
+
+
+def wiki_page_v3(rng, count, v2_count=0):
+    """A legacy user page of deltas, possibly followed by v2 content"""
+    lines = ['/u/awardee has received {} deltas:'.format(count), '',
+             '| Date | Submission | Delta Comment | Awarded By |',
+             '| --- | :-: | --- | --- |']
+    for _ in range(count):
+        title, url = _cmv_submission(rng)
+        lines.append('|{}|[{}]({})|[Link]({}{}?context=2)|/u/{}|'.format(
+            _cmv_date(rng), title, url, url, random_id(rng),
+            _cmv_username(rng)))
+    if v2_count:
+        lines.extend(['', 'Deltas awarded before:', '',
+                      wiki_page_v2(rng, v2_count)])
+    return '\n'.join(lines) + '\n'
+
+
+def wiki_page_v2(rng, count, searched_ratio=0.1):
+    """A legacy user page of submissions and their deltas
+    
+    Some submissions are listed without their deltas, as in the oldest pages.
+    """
+    lines = []
+    for _ in range(count):
+        title, url = _cmv_submission(rng)
+        delta_count = rng.randint(1, 3)
+        lines.append('* [{}]({}) ({})'.format(title, url, delta_count))
+        if rng.random() < searched_ratio:
+            continue
+        for _ in range(delta_count):
+            lines.append('    1. [Awarded by /u/{}]({}{}?context=2) on '
+                         '{}'.format(_cmv_username(rng), url,
+                                     random_id(rng), _cmv_date(rng)))
+    return '\n'.join(lines) + '\n'
+
+
+def wiki_page_v1(rng, count):
+    """A legacy user page of submissions only"""
+    lines = []
+    for _ in range(count):
+        title, url = _cmv_submission(rng)
+        lines.append('* [{}]({})'.format(title, url))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,168 @@
+#!/usr/bin/env python2.7
+
+"""Run the benchmarks offline, against the App Engine testbed
+
+Results are written as JSON, so that runs on different commits can be
+compared:
+    
+    benchmarks/run.py --output before.json
+    git checkout some-branch
+    benchmarks/run.py --baseline before.json --output after.json
+
+With a baseline, the run fails if a benchmark got slower than the threshold
+allows.  Timings are the best time per call among several runs.
+"""
+
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SDK_PATH = '/usr/local/google_appengine'
+
+
+def _setup_sdk(sdk_path):
+    sys.path.insert(0, ROOT)
+    if os.path.exists(os.path.join(sdk_path, 'platform/google_appengine')):
+        sys.path.insert(0, os.path.join(sdk_path, 'platform/google_appengine'))
+    else:
+        sys.path.insert(0, sdk_path)
+    
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    
+    import appengine_config  # noqa
+
+
+def _activate_testbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb, testbed
+    
+    tb = testbed.Testbed()
+    tb.activate()
+    # Writes are applied right away, like in the tests
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    tb.init_datastore_v3_stub(consistency_policy=policy)
+    tb.init_memcache_stub()
+    # Measure the datastore, not the context cache
+    ndb.get_context().set_cache_policy(False)
+    return tb
+
+
+def _time(function, repeat, min_time):
+    """Return the best and median times per call of several runs"""
+    timer = timeit.Timer(function)
+    # Enough calls per run for the timer's resolution not to matter
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    
+    times = sorted([elapsed] + timer.repeat(repeat - 1, number))
+    return {
+        'best': times[0] / number,
+        'median': times[len(times) // 2] / number,
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def run(benchmarks, repeat, min_time, name_filter=None):
+    results = {}
+    for bench in benchmarks:
+        for param in bench.params:
+            name = '{}[{}]'.format(bench.name, param)
+            if name_filter and name_filter not in name:
+                continue
+            
+            tb = _activate_testbed()
+            try:
+                function = bench.function(param)
+                results[name] = _time(function, repeat, min_time)
+            finally:
+                tb.deactivate()
+            
+            sys.stderr.write('{:<55} {:>12.3f} us\n'.format(
+                name, results[name]['best'] * 1e6))
+    return results
+
+
+def compare(baseline, results, threshold):
+    """Print the changes since the baseline and return the regressions"""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name]['best'] / baseline[name]['best']
+        regressed = ratio > 1 + threshold
+        sys.stderr.write('{:<55} {:>+8.1%}{}\n'.format(
+            name, ratio - 1, '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sdk', default=os.environ.get('GAE_SDK', SDK_PATH),
+                        help='App Engine SDK path, default: $GAE_SDK or '
+                             '{}'.format(SDK_PATH))
+    parser.add_argument('--filter', help='only run the benchmarks whose '
+                                         'name contains this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum duration of a run, in seconds')
+    parser.add_argument('--output', help='file to write the results to, '
+                                         'default: standard output')
+    parser.add_argument('--baseline', help='results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='slowdown tolerated before failing, default: '
+                             '0.25 for 25%%')
+    args = parser.parse_args()
+    
+    _setup_sdk(args.sdk)
+    from benchmarks.bench_deltabot import BENCHMARKS
+    
+    results = run(BENCHMARKS, args.repeat, args.min_time, args.filter)
+    output = {
+        'commit': _get_commit(),
+        'python': platform.python_version(),
+        'date': datetime.utcnow().isoformat(),
+        'results': results,
+    }
+    
+    output_json = json.dumps(output, indent=2, separators=(',', ': '),
+                             sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output_json + '\n')
+    else:
+        print(output_json)
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            sys.exit('{} regression(s) over {:.0%}'.format(len(regressions),
+                                                           args.threshold))
+
+
+if __name__ == '__main__':
+    main()
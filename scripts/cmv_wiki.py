@@ -0,0 +1,243 @@
+"""Parser of the user pages of the /r/changemyview wiki
+
+Pages have been in three formats over time:
+* v3, a table of the deltas, possibly followed by content in the v2 format
+* v2, a list of the submissions, each with the comments awarded a delta
+* v1, a list of the submissions only, whose threads have to be searched
+
+Pages are tokenized once, line by line, with the patterns matched in place
+rather than on copies of the content.  Deltas are yielded as they're parsed.
+Threads are searched by a function taking the submission URL and awardee,
+and returning their deltas.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+import re
+import warnings
+
+ParsedDelta = namedtuple('ParsedDelta', [
+    'awarded_at',
+    'awarded_by',
+    'awarder_comment_id',
+    'awarder_comment_url',
+    'submission_id',
+    'submission_title',
+    'submission_url',
+])
+
+V3_HEADER = '| --- | :-: | --- | --- |'
+
+RE_USER_PAGE_V3 = re.compile(
+    r"""(?mx)
+        ^\|(?P<awarded_at>\d+/\d+/\d+)\|
+        \[(?P<submission_title>.+?)\]
+        \((?P<submission_url>http://www\.reddit\.com/r/changemyview/comments/
+            (?P<submission_id>\w+)/.+/)\)\|
+        \[Link\]\((?P<comment_url>http://www\.reddit\.com/r/changemyview/
+            comments/\w+/.+/(?P<comment_id>\w+))\?context=2\)\|
+        /u/(?P<awarded_by>\w+)\|$""")
+
+RE_USER_PAGE_V2_SUBMISSION = re.compile(
+    r"""(?mx)
+        ^\*\s\[(?P<submission_title>.+)\]
+            \((?P<submission_url>http://www\.reddit\.com/r/changemyview/
+                comments/(?P<submission_id>\w+)/.+/)\)\s
+        \((?P<delta_count>\d)\)""")
+
+RE_USER_PAGE_V2_COMMENT = re.compile(
+    r"""(?mx)
+        ^\s+1\.\s\[Awarded\sby\s/u/(?P<awarded_by>\w+)\]
+            \((?P<comment_url>http://www\.reddit\.com/r/changemyview/comments/
+                \w+/.+/(?P<comment_id>\w+))\?context=2\)\s
+        on\s(?P<awarded_at>\d+/\d+/\d+)$""")
+
+RE_USER_PAGE_V1 = re.compile(
+    r"""(?mx)
+        ^\*\x20\[(?P<submission_title>.+)\]
+            \((?P<submission_url>http://www\.reddit.com/r/changemyview/
+                comments/(?P<submission_id>\w+)/.+/)""")
+
+# Kinds of lines
+V3_HEADER_LINE = 'v3_header'
+V3_ROW = 'v3_row'
+V2_SUBMISSION = 'v2_submission'
+V2_COMMENT = 'v2_comment'
+V1_SUBMISSION = 'v1_submission'
+
+
+def parse_date(date_str):
+    month, day, year = date_str.split('/')
+    # strptime() is most of the parsing time otherwise
+    if len(month) <= 2 and len(day) <= 2 and len(year) == 4:
+        return datetime(int(year), int(month), int(day))
+    return datetime.strptime(date_str, '%m/%d/%Y')
+
+
+def _match_line(page_content, pos, end):
+    first_char = page_content[pos:pos + 1]
+    if first_char == '|':
+        if (end - pos == len(V3_HEADER) and
+                page_content.startswith(V3_HEADER, pos)):
+            return V3_HEADER_LINE, None
+        m = RE_USER_PAGE_V3.match(page_content, pos, end)
+        if m:
+            return V3_ROW, m
+    elif first_char == '*':
+        # v1 lines are a prefix of v2 ones
+        m = RE_USER_PAGE_V2_SUBMISSION.match(page_content, pos)
+        if m:
+            return V2_SUBMISSION, m
+        m = RE_USER_PAGE_V1.match(page_content, pos)
+        if m:
+            return V1_SUBMISSION, m
+    elif first_char.isspace():
+        m = RE_USER_PAGE_V2_COMMENT.match(page_content, pos)
+        if m:
+            return V2_COMMENT, m
+    return None, None
+
+
+def tokenize(page_content):
+    """Yield the (kind, match, end) of every line, end being where it ends
+    
+    The kind is None for the lines that aren't in any of the formats.
+    """
+    pos = 0
+    while True:
+        end = page_content.find('\n', pos)
+        if end == -1:
+            end = len(page_content)
+        kind, m = _match_line(page_content, pos, end)
+        if m is not None and m.end() > end:
+            # Whitespace in the patterns may span several lines
+            end = page_content.find('\n', m.end())
+            if end == -1:
+                end = len(page_content)
+        yield kind, m, end
+        
+        if end == len(page_content):
+            return
+        pos = end + 1
+
+
+def _parse_v3_row(m):
+    return ParsedDelta(
+        awarded_at=parse_date(m.group('awarded_at')),
+        awarded_by=m.group('awarded_by'),
+        awarder_comment_id=m.group('comment_id'),
+        awarder_comment_url=m.group('comment_url'),
+        submission_id=m.group('submission_id'),
+        submission_title=m.group('submission_title'),
+        submission_url=m.group('submission_url'))
+
+
+def _parse_v2_comment(m, submission_m):
+    return ParsedDelta(
+        awarded_at=parse_date(m.group('awarded_at')),
+        awarded_by=m.group('awarded_by'),
+        awarder_comment_id=m.group('comment_id'),
+        awarder_comment_url=m.group('comment_url'),
+        submission_id=submission_m.group('submission_id'),
+        submission_title=submission_m.group('submission_title'),
+        submission_url=submission_m.group('submission_url'))
+
+
+def _search_v2_submission(submission_m, username, search_thread):
+    """Return the deltas of a submission listed without its comments"""
+    found_deltas = search_thread(submission_m.group('submission_url'),
+                                 username)
+    delta_count = int(submission_m.group('delta_count'))
+    if len(found_deltas) != delta_count:
+        warnings.warn('/u/{}: delta count is {}, found {}'
+                      .format(username, delta_count, len(found_deltas)))
+    return found_deltas
+
+
+def _parse_v2(lines, page_content, start, username, search_thread):
+    """Yield the deltas of the lines of a page from start on, as v2 or v1"""
+    delta_count = 0
+    submission_m = None
+    comment_count = 0
+    v1_matches = []
+    
+    for kind, m, _ in lines:
+        if kind == V2_SUBMISSION:
+            if submission_m is not None and not comment_count:
+                for delta in _search_v2_submission(submission_m, username,
+                                                   search_thread):
+                    delta_count += 1
+                    yield delta
+            submission_m = m
+            comment_count = 0
+        elif kind == V2_COMMENT and submission_m is not None:
+            comment_count += 1
+            delta_count += 1
+            yield _parse_v2_comment(m, submission_m)
+        elif kind == V1_SUBMISSION and submission_m is None:
+            v1_matches.append(m)
+    
+    if submission_m is not None:
+        if not comment_count:
+            for delta in _search_v2_submission(submission_m, username,
+                                               search_thread):
+                delta_count += 1
+                yield delta
+    elif (start >= len(page_content) or
+            page_content.find('/r/PixelOrange', start) != -1):
+        return
+    else:
+        for m in v1_matches:
+            for delta in search_thread(m.group('submission_url'), username):
+                delta_count += 1
+                yield delta
+    
+    if not delta_count:
+        warnings.warn('/u/{}: v2: no deltas'.format(username))
+
+
+def parse_user_page(page_content, username, search_thread):
+    """Yield the deltas of a user page, whatever its format
+    
+    The v3 table ends at its first line that isn't a row, and the rest is
+    parsed as v2.  Pages without any v3 row are parsed as v2 altogether.
+    """
+    lines = tokenize(page_content)
+    # Kept until the page turns out to be v3
+    seen_lines = []
+    found_v3 = past_header = False
+    
+    for line in lines:
+        kind, m, end = line
+        if kind == V3_HEADER_LINE:
+            past_header = True
+        elif kind == V3_ROW:
+            found_v3 = True
+            seen_lines = None
+            yield _parse_v3_row(m)
+        elif past_header:
+            rest = lines if found_v3 else list(lines)
+            found_rest = False
+            for delta in _parse_v2(rest, page_content, end + 1, username,
+                                   search_thread):
+                found_rest = True
+                yield delta
+            if found_v3 or found_rest:
+                return
+            seen_lines.append(line)
+            seen_lines.extend(rest)
+            break
+        
+        if seen_lines is not None:
+            seen_lines.append(line)
+    
+    if not found_v3:
+        for delta in _parse_v2(seen_lines, page_content, 0, username,
+                               search_thread):
+            yield delta
+
+
+def parse_user_page_v2(page_content, username, search_thread):
+    """Yield the deltas of a page of the former user history, in v2"""
+    return _parse_v2(tokenize(page_content), page_content, 0, username,
+                     search_thread)
@@ -0,0 +1,572 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+"""Local stand-in for the parts of Reddit's API the bot uses
+
+Point a praw.ini site at it (see praw.ini.example) to run the consumers end
+to end without a network, e.g. with the dev server and REDDIT_SITE = 'dev':
+    
+    scripts/fake_reddit.py --site dev --comments 500 --latency 0.2
+
+It listens on the host and port of the site's domain.  Everything is kept in
+memory and lost when it stops.  Counters of the requests served are
+available at /_fake/stats, and new comments can be posted as JSON to
+/_fake/comments.
+"""
+
+import argparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from ConfigParser import SafeConfigParser
+from collections import defaultdict
+import json
+import os
+import random
+import re
+from SocketServer import ThreadingMixIn
+import threading
+import time
+from urlparse import parse_qs, urlparse
+import uuid
+
+ALL_SCOPES = ('edit flair history identity modconfig modflair modlog '
+              'modposts modwiki mysubreddits privatemessages read report '
+              'save submit subscribe vote wikiedit wikiread')
+
+RATELIMIT_WINDOW = 600
+
+
+def to_base36(number):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    result = ''
+    while True:
+        number, digit = divmod(number, 36)
+        result = digits[digit] + result
+        if not number:
+            return result
+
+
+def listing(things, before=None, after=None):
+    return {'kind': 'Listing',
+            'data': {'children': things, 'before': before, 'after': after,
+                     'modhash': ''}}
+
+
+class FakeReddit(object):
+    """In-memory state of the fake Reddit"""
+    
+    def __init__(self, subreddit, bot_username, moderators):
+        self.lock = threading.Lock()
+        self.subreddit = subreddit
+        self.bot_username = bot_username
+        self.moderators = moderators
+        
+        self._next_id = 36 ** 5
+        self.submissions = {}
+        self.comments = {}
+        self.comment_ids = []  # oldest first
+        self.messages = {}
+        self.message_ids = []  # oldest first
+        self.flairs = {}
+        self.link_flairs = {}
+        self.wiki_pages = {}
+        self.tokens = {}
+    
+    def _new_id(self):
+        self._next_id += 1
+        return to_base36(self._next_id)
+    
+    def add_submission(self, author, title):
+        with self.lock:
+            submission_id = self._new_id()
+            permalink = '/r/{}/comments/{}/_/'.format(self.subreddit,
+                                                      submission_id)
+            self.submissions[submission_id] = {
+                'id': submission_id,
+                'name': 't3_' + submission_id,
+                'author': author,
+                'title': title,
+                'url': 'https://www.reddit.com' + permalink,
+                'permalink': permalink,
+                'subreddit': self.subreddit,
+                'created_utc': time.time(),
+                'score': 1,
+                'num_comments': 0,
+            }
+            return submission_id
+    
+    def add_comment(self, author, body, parent_fullname):
+        with self.lock:
+            if parent_fullname.startswith('t3_'):
+                submission = self.submissions[parent_fullname[3:]]
+            else:
+                parent = self.comments[parent_fullname[3:]]
+                submission = self.submissions[parent['link_id'][3:]]
+            
+            comment_id = self._new_id()
+            comment = {
+                'id': comment_id,
+                'name': 't1_' + comment_id,
+                'author': author,
+                'body': body,
+                'parent_id': parent_fullname,
+                'link_id': submission['name'],
+                'link_title': submission['title'],
+                'link_url': submission['url'],
+                'link_author': submission['author'],
+                'subreddit': self.subreddit,
+                'created_utc': time.time(),
+                'distinguished': None,
+                'replies': '',
+            }
+            self.comments[comment_id] = comment
+            self.comment_ids.append(comment_id)
+            submission['num_comments'] += 1
+            return comment
+    
+    def add_message(self, author, subject, body):
+        with self.lock:
+            message_id = self._new_id()
+            self.messages[message_id] = {
+                'id': message_id,
+                'name': 't4_' + message_id,
+                'author': author,
+                'subject': subject,
+                'body': body,
+                'dest': self.bot_username,
+                'subreddit': None,
+                'was_comment': False,
+                'created_utc': time.time(),
+                'replies': '',
+            }
+            self.message_ids.append(message_id)
+            return message_id
+    
+    def get_thing(self, fullname):
+        kind, _, thing_id = fullname.partition('_')
+        if kind == 't1' and thing_id in self.comments:
+            return {'kind': 't1', 'data': self.comments[thing_id]}
+        elif kind == 't3' and thing_id in self.submissions:
+            return {'kind': 't3', 'data': self.submissions[thing_id]}
+        elif kind == 't4' and thing_id in self.messages:
+            return {'kind': 't4', 'data': self.messages[thing_id]}
+        return None
+    
+    def get_listing(self, kind, ids, params):
+        """Return a page of a listing, newest first, like Reddit does"""
+        limit = min(int(params.get('limit', 25)), 100)
+        before = params.get('before', '')[3:]
+        after = params.get('after', '')[3:]
+        
+        with self.lock:
+            newest_first = ids[::-1]
+            if after:  # takes precedence, as PRAW adds it to 'before'
+                if after not in newest_first:
+                    return listing([])
+                start = newest_first.index(after) + 1
+                page_ids = newest_first[start:start + limit]
+            elif before:
+                if before not in newest_first:
+                    return listing([])
+                end = newest_first.index(before)
+                page_ids = newest_first[max(end - limit, 0):end]
+            else:
+                page_ids = newest_first[:limit]
+            things = [self.get_thing('{}_{}'.format(kind, thing_id))
+                      for thing_id in page_ids]
+        
+        if not things:
+            return listing([])
+        has_older = page_ids[-1] != newest_first[-1]
+        return listing(things, before=things[0]['data']['name'],
+                       after=things[-1]['data']['name'] if has_older else None)
+
+
+class Faults(object):
+    """Latency, rate limiting and failures to inject"""
+    
+    def __init__(self, latency, jitter, failure_rate, ratelimit, token_ttl):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.ratelimit = ratelimit
+        self.token_ttl = token_ttl
+        
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._used = 0
+    
+    def sleep(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+    
+    def fails(self):
+        return random.random() < self.failure_rate
+    
+    def consume_ratelimit(self):
+        """Count a request and return the rate limit headers"""
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= RATELIMIT_WINDOW:
+                self._window_start = now
+                self._used = 0
+            self._used += 1
+            reset = int(self._window_start + RATELIMIT_WINDOW - now)
+            remaining = max(self.ratelimit - self._used, 0)
+            return {
+                'X-Ratelimit-Used': str(self._used),
+                'X-Ratelimit-Remaining': '{:.1f}'.format(remaining),
+                'X-Ratelimit-Reset': str(reset),
+            }, self._used > self.ratelimit
+
+
+class Stats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests = defaultdict(int)
+        self.statuses = defaultdict(int)
+        self.total_time = defaultdict(float)
+    
+    def record(self, endpoint, status, duration):
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.statuses[str(status)] += 1
+            self.total_time[endpoint] += duration
+    
+    def to_dict(self):
+        with self._lock:
+            elapsed = time.time() - self.started_at
+            return {
+                'elapsed': elapsed,
+                'requests': dict(self.requests),
+                'statuses': dict(self.statuses),
+                'mean_time': dict((endpoint, total / self.requests[endpoint])
+                                  for endpoint, total
+                                  in self.total_time.items()),
+                'requests_per_second': (sum(self.requests.values()) /
+                                        elapsed if elapsed else 0),
+            }
+
+
+class HTTPError(Exception):
+    def __init__(self, status, body=None, headers=None):
+        self.status = status
+        self.body = body or {'error': status}
+        self.headers = headers or {}
+
+
+class Handler(BaseHTTPRequestHandler):
+    reddit = None
+    faults = None
+    stats = None
+    
+    ROUTES = [
+        ('POST', r'^api/v1/access_token$', '_access_token'),
+        ('GET', r'^r/(\w+)/comments$', '_comments'),
+        ('GET', r'^message/messages$', '_messages'),
+        ('GET', r'^api/info$', '_info'),
+        ('GET', r'^comments/(\w+)(?:/_/(\w+))?$', '_submission'),
+        ('POST', r'^api/comment$', '_reply'),
+        ('POST', r'^api/distinguish$', '_distinguish'),
+        ('POST', r'^api/flair$', '_flair'),
+        ('POST', r'^api/flaircsv$', '_flair_csv'),
+        ('POST', r'^api/wiki/edit$', '_wiki_edit'),
+        ('GET', r'^r/(\w+)/about/moderators$', '_moderators'),
+        ('GET', r'^_fake/stats$', '_stats'),
+        ('POST', r'^_fake/comments$', '_new_comment'),
+    ]
+    
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+    
+    def do_GET(self):
+        self._handle('GET')
+    
+    def do_POST(self):
+        self._handle('POST')
+    
+    def _handle(self, method):
+        start = time.time()
+        url = urlparse(self.path)
+        path = re.sub(r'(\.json)?$', '', url.path).strip('/')
+        self.params = dict((key, values[-1]) for key, values
+                           in parse_qs(url.query).items())
+        if method == 'POST':
+            length = int(self.headers.getheader('Content-Length') or 0)
+            self.params.update((key, values[-1]) for key, values
+                               in parse_qs(self.rfile.read(length)).items())
+        
+        for route_method, pattern, handler_name in self.ROUTES:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            handler_name = None
+        
+        headers = {}
+        try:
+            if handler_name is None:
+                raise HTTPError(404)
+            if not handler_name.startswith('_fake'):
+                headers, limited = self.faults.consume_ratelimit()
+                self.faults.sleep()
+                if limited:
+                    raise HTTPError(429, headers=headers)
+                if self.faults.fails():
+                    raise HTTPError(503)
+            status = 200
+            body = getattr(self, handler_name)(*match.groups())
+        except HTTPError as e:
+            status = e.status
+            body = e.body
+            headers.update(e.headers)
+        
+        self.stats.record(handler_name or '404', status, time.time() - start)
+        
+        payload = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+    
+    def _check_token(self):
+        """Reject expired or unknown access tokens"""
+        authorization = self.headers.getheader('Authorization')
+        if authorization is None:
+            return  # praw only sends it for the endpoints it knows need it
+        token = authorization.partition(' ')[2]
+        expires_at = self.reddit.tokens.get(token)
+        if expires_at is None or expires_at <= time.time():
+            raise HTTPError(401, headers={
+                'WWW-Authenticate': 'Bearer realm="reddit", '
+                                    'error="invalid_token"'})
+    
+    def _access_token(self):
+        if self.params.get('grant_type') != 'refresh_token':
+            return {'error': 'unsupported_grant_type'}
+        token = uuid.uuid4().hex
+        self.reddit.tokens[token] = time.time() + self.faults.token_ttl
+        return {'access_token': token, 'token_type': 'bearer',
+                'expires_in': self.faults.token_ttl, 'scope': ALL_SCOPES}
+    
+    def _comments(self, subreddit):
+        self._check_token()
+        if subreddit != self.reddit.subreddit:
+            return listing([])
+        return self.reddit.get_listing('t1', self.reddit.comment_ids,
+                                       self.params)
+    
+    def _messages(self):
+        self._check_token()
+        return self.reddit.get_listing('t4', self.reddit.message_ids,
+                                       self.params)
+    
+    def _info(self):
+        self._check_token()
+        things = [self.reddit.get_thing(fullname)
+                  for fullname in self.params.get('id', '').split(',')]
+        return listing([thing for thing in things if thing])
+    
+    def _submission(self, submission_id, comment_id):
+        self._check_token()
+        submission = self.reddit.get_thing('t3_' + submission_id)
+        if submission is None:
+            raise HTTPError(404)
+        comments = []
+        if comment_id:
+            comment = self.reddit.get_thing('t1_' + comment_id)
+            comments = [comment] if comment else []
+        return [listing([submission]), listing(comments)]
+    
+    def _reply(self):
+        self._check_token()
+        if not self.reddit.get_thing(self.params.get('thing_id', '')):
+            return {'json': {'errors': [['DELETED_COMMENT', 'deleted',
+                                         'parent']]}}
+        comment = self.reddit.add_comment(self.reddit.bot_username,
+                                          self.params.get('text', ''),
+                                          self.params['thing_id'])
+        return {'json': {'errors': [], 'data': {
+            'things': [{'kind': 't1', 'data': comment}]}}}
+    
+    def _distinguish(self):
+        self._check_token()
+        thing = self.reddit.get_thing(self.params.get('id', ''))
+        if thing is None:
+            raise HTTPError(404)
+        thing['data']['distinguished'] = 'moderator'
+        return {'json': {'errors': [], 'data': {'things': [thing]}}}
+    
+    def _flair(self):
+        self._check_token()
+        flair = (self.params.get('text'), self.params.get('css_class'))
+        if 'link' in self.params:
+            self.reddit.link_flairs[self.params['link']] = flair
+        else:
+            self.reddit.flairs[self.params.get('name')] = flair
+        return {'json': {'errors': []}}
+    
+    def _flair_csv(self):
+        self._check_token()
+        results = []
+        for line in self.params.get('flair_csv', '').splitlines():
+            user, _, rest = line.partition(',')
+            text, _, css_class = rest.partition(',')
+            self.reddit.flairs[user] = (text, css_class)
+            results.append({'ok': True, 'status': 'added flair for user',
+                            'errors': {}, 'warnings': {}})
+        return results
+    
+    def _wiki_edit(self):
+        self._check_token()
+        self.reddit.wiki_pages[self.params.get('page')] = (
+            self.params.get('content'))
+        return {}
+    
+    def _moderators(self, subreddit):
+        self._check_token()
+        moderators = [{'name': name, 'id': 't2_' + to_base36(i),
+                       'mod_permissions': ['all'], 'date': time.time()}
+                      for i, name in enumerate(self.reddit.moderators)]
+        return {'kind': 'UserList', 'data': {'children': moderators}}
+    
+    def _stats(self):
+        stats = self.stats.to_dict()
+        stats.update({
+            'comments': len(self.reddit.comment_ids),
+            'messages': len(self.reddit.message_ids),
+            'flairs': len(self.reddit.flairs),
+            'wiki_pages': len(self.reddit.wiki_pages),
+        })
+        return stats
+    
+    def _new_comment(self):
+        comment = self.reddit.add_comment(self.params['author'],
+                                          self.params['body'],
+                                          self.params['parent_id'])
+        return {'kind': 't1', 'data': comment}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    verbose = False
+
+
+def seed(reddit, submissions, comments, delta_ratio, delta_token):
+    """Create submissions and comments, some of them awarding deltas"""
+    users = ['user{}'.format(i) for i in range(max(comments // 10, 2))]
+    submission_ids = [reddit.add_submission(random.choice(users),
+                                            'Submission {}'.format(i))
+                      for i in range(submissions)]
+    
+    parents = dict((submission_id, ['t3_' + submission_id])
+                   for submission_id in submission_ids)
+    for i in range(comments):
+        submission_id = random.choice(submission_ids)
+        parent_fullname = random.choice(parents[submission_id])
+        if random.random() < delta_ratio and len(parents[submission_id]) > 1:
+            parent_fullname = random.choice(parents[submission_id][1:])
+            body = u'{} Good point, you changed my view.'.format(delta_token)
+        else:
+            body = u'Comment {}, nothing to see here.'.format(i)
+        comment = reddit.add_comment(random.choice(users), body,
+                                     parent_fullname)
+        parents[submission_id].append(comment['name'])
+
+
+def generate_comments(reddit, rate, delta_ratio, delta_token):
+    """Keep adding comments to random submissions, at a rate per second"""
+    while True:
+        time.sleep(random.expovariate(rate))
+        with reddit.lock:
+            comment_ids = reddit.comment_ids[-100:]
+        if not comment_ids:
+            continue
+        parent = reddit.comments[random.choice(comment_ids)]
+        if random.random() < delta_ratio:
+            body = u'{} Fair enough.'.format(delta_token)
+        else:
+            body = u'I disagree.'
+        reddit.add_comment('user{}'.format(random.randint(0, 99)), body,
+                           parent['name'])
+
+
+def get_site_address(praw_ini, site):
+    parser = SafeConfigParser()
+    if not parser.read(praw_ini):
+        raise SystemExit("Couldn't read {}".format(praw_ini))
+    domain = parser.get(site, 'domain')
+    host, _, port = domain.partition(':')
+    return host, int(port or 80)
+
+
+def main():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--praw-ini', default=os.path.join(root, 'praw.ini'))
+    parser.add_argument('--site', default='dev',
+                        help='praw.ini site to serve, default: dev')
+    parser.add_argument('--subreddit', default='devsub')
+    parser.add_argument('--bot-username', default='mybot')
+    parser.add_argument('--moderators', default='mod1,mod2',
+                        help='comma-separated usernames')
+    parser.add_argument('--submissions', type=int, default=20)
+    parser.add_argument('--comments', type=int, default=200,
+                        help='comments created on startup')
+    parser.add_argument('--comment-rate', type=float, default=0,
+                        help='new comments per second while running')
+    parser.add_argument('--delta-ratio', type=float, default=0.1,
+                        help='share of comments awarding a delta')
+    parser.add_argument('--delta-token', default=u'∆')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to each API request')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='random variation of the latency, in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='share of API requests failing with a 503')
+    parser.add_argument('--ratelimit', type=int, default=600,
+                        help='requests allowed per 10 minutes')
+    parser.add_argument('--token-ttl', type=int, default=3600,
+                        help='lifetime of access tokens, in seconds')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    
+    delta_token = args.delta_token
+    if isinstance(delta_token, str):
+        delta_token = delta_token.decode('utf-8')
+    
+    reddit = FakeReddit(args.subreddit, args.bot_username,
+                        args.moderators.split(','))
+    seed(reddit, args.submissions, args.comments, args.delta_ratio,
+         delta_token)
+    
+    Handler.reddit = reddit
+    Handler.faults = Faults(args.latency, args.jitter, args.failure_rate,
+                            args.ratelimit, args.token_ttl)
+    Handler.stats = Stats()
+    
+    if args.comment_rate > 0:
+        thread = threading.Thread(target=generate_comments,
+                                  args=(reddit, args.comment_rate,
+                                        args.delta_ratio, delta_token))
+        thread.daemon = True
+        thread.start()
+    
+    address = get_site_address(args.praw_ini, args.site)
+    server = ThreadingHTTPServer(address, Handler)
+    server.verbose = args.verbose
+    print('Serving /r/{} on http://{}:{}'.format(args.subreddit, *address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,18 @@
 #!/usr/bin/env python2.7
 
-"""Quick and dirty script to import deltas from the /r/changemyview wiki"""
+"""Quick and dirty script to import deltas from the /r/changemyview wiki
+
+User pages are fetched and parsed by a pool of threads, and their deltas
+written in batches.  The users done are saved to a checkpoint file after
+each batch, so that an interrupted import resumes where it stopped.  Deltas
+that already exist are left as is, so importing again doesn't undo their
+approval or removal.  The users' stats are rebuilt at the end, which also
+updates the flairs, wiki pages and tracker of the users with new deltas.
+
+Older pages only link to the threads, which are then searched for DeltaBot's
+confirmations.  Each thread is fetched once for all of its awardees, and
+kept on disk for the next runs.
+"""
 
 import os
 import sys
@@ -30,17 +42,29 @@ def auth_func():
 remote_api_stub.ConfigureRemoteApi(None, '/_ah/remote_api', auth_func,
                                    'localhost:8080', save_cookies=True)
 
-from collections import namedtuple
+import argparse
+from collections import defaultdict
 from datetime import datetime
+from functools import partial
+import json
+from multiprocessing.pool import ThreadPool
 import re
+import threading
+import time
 import warnings
 
+from google.appengine.ext import ndb
 from praw.errors import OAuthInvalidToken
+from praw.helpers import flatten_tree
 from praw.objects import Submission
 from requests.exceptions import HTTPError
 
+from application.deltabot.bot import rebuild_user_stats
 from application.deltabot.models import Delta
-from application.deltabot.utils import get_reddit, ndb_model
+from application.deltabot.utils import (RedditRateLimited, defer, delta_key,
+                                        get_reddit, get_reddit_backoff,
+                                        invalidate_access_info)
+from cmv_wiki import ParsedDelta, parse_user_page, parse_user_page_v2
 
 
 class Unbuffered(object):
@@ -66,22 +90,12 @@ def warning_on_one_line(message, category, filename, lineno, file=None,
 
 warnings.formatwarning = warning_on_one_line
 
-r = get_reddit()
-r.refresh_access_information()
-
-ParsedDelta = namedtuple('ParsedDelta', [
-    'awarded_at',
-    'awarded_by',
-    'awarder_comment_id',
-    'awarder_comment_url',
-    'submission_id',
-    'submission_title',
-    'submission_url',
-])
-
-
-def parse_date(date_str):
-    return datetime.strptime(date_str, '%m/%d/%Y')
+CHECKPOINT_FILENAME = os.path.join(os.path.dirname(__file__),
+                                   'import_cmv_deltas.checkpoint')
+THREADS_DIR = os.path.join(os.path.dirname(__file__),
+                           'import_cmv_deltas.threads')
+PUT_BATCH_SIZE = 200
+FETCH_ATTEMPTS = 3
 
 
 def to_https(url):
@@ -91,9 +105,16 @@ def to_https(url):
         warnings.warn('not an https url: {}'.format(url))
 
 
+def write_json(filename, obj):
+    # Written aside then renamed, so that it's never left half written
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.rename(filename + '.tmp', filename)
+
+
 def to_ndb_delta(parsed_delta, awardee_username):
-    return ndb_model(
-        Delta,
+    return Delta(
+        key=delta_key(awardee_username, parsed_delta.awarder_comment_id),
         awarded_at=parsed_delta.awarded_at,
         awarded_by=parsed_delta.awarded_by,
         awarded_to=awardee_username,
@@ -118,218 +139,257 @@ def parse_list_file(filename):
     return values
 
 
-RE_USER_PAGE_V3 = re.compile(
-    r"""(?x)
-        ^\|(?P<awarded_at>\d+/\d+/\d+)\|
-        \[(?P<submission_title>.+?)\]
-        \((?P<submission_url>http://www\.reddit\.com/r/changemyview/comments/
-            (?P<submission_id>\w+)/.+/)\)\|
-        \[Link\]\((?P<comment_url>http://www\.reddit\.com/r/changemyview/
-            comments/\w+/.+/(?P<comment_id>\w+))\?context=2\)\|
-        /u/(?P<awarded_by>\w+)\|$""")
+RE_SUBMISSION_ID = re.compile(r'/comments/(?P<submission_id>\w+)')
 
-
-def parse_user_page_v3(page_content, username):
-    parsed_deltas = []
-    past_header = False
-    pos = 0
-    
-    for line in page_content.split('\n'):
-        pos += len(line) + 1
-        
-        if line == '| --- | :-: | --- | --- |':
-            past_header = True
-            continue
-        
-        m = RE_USER_PAGE_V3.search(line)
-        if not m:
-            if past_header:
-                parsed_deltas.extend(parse_user_page_v2(page_content[pos:],
-                                                        username))
-                break
-            continue
-        
-        parsed_deltas.append(ParsedDelta(
-            awarded_at=parse_date(m.group('awarded_at')),
-            awarded_by=m.group('awarded_by'),
-            awarder_comment_id=m.group('comment_id'),
-            awarder_comment_url=m.group('comment_url'),
-            submission_id=m.group('submission_id'),
-            submission_title=m.group('submission_title'),
-            submission_url=m.group('submission_url')))
-    
-    if not parsed_deltas:
-        parsed_deltas.extend(parse_user_page_v2(page_content, username))
-    
-    return parsed_deltas
+RE_DELTA_CONFIRMATION = re.compile(r'delta awarded to /u/(?P<username>[\w-]+)',
+                                   re.IGNORECASE)
 
 
-def search_deltas_thread(submission_url, awardee_username):
-    parsed_deltas = []
+def fetch_thread(r, submission_url):
+    """Return the comments of a submission that matter to the extraction
     
+    Comments are [id, parent fullname, author, created_utc, body] lists,
+    with the body of DeltaBot's comments only.
+    """
     submission = Submission.from_url(r, submission_url, comment_limit=None)
     submission.replace_more_comments(limit=16, threshold=1)
     
-    keyphrase = 'delta awarded to /u/{}'.format(awardee_username).lower()
-    
-    def search_comment(comment, parent):
-        if (getattr(comment.author, 'name', None) == 'DeltaBot' and
-                keyphrase in comment.body.lower()):
-            awarded_at = datetime.fromtimestamp(parent.created_utc)
-            awarded_by = getattr(parent.author, 'name', '[deleted]')
-            parsed_deltas.append(ParsedDelta(
-                awarded_at=awarded_at,
-                awarded_by=awarded_by,
-                awarder_comment_id=parent.id,
-                awarder_comment_url=submission.url + parent.id,
-                submission_id=submission.id,
-                submission_title=submission.title,
-                submission_url=submission.url))
-        for reply in comment.replies:
-            search_comment(reply, comment)
-    
-    for comment in submission.comments:
-        for reply in comment.replies:
-            search_comment(reply, comment)
+    comments = []
+    for comment in flatten_tree(submission.comments):
+        author = getattr(comment.author, 'name', None)
+        body = comment.body if author == 'DeltaBot' else None
+        comments.append([comment.id, comment.parent_id, author,
+                         comment.created_utc, body])
+    return {
+        'id': submission.id,
+        'title': submission.title,
+        'url': submission.url,
+        'comments': comments,
+    }
+
+
+def extract_thread_deltas(thread):
+    """Return the deltas DeltaBot confirmed in a thread, by awardee
     
-    return parsed_deltas
-
-
-RE_USER_PAGE_V2_SUBMISSION = re.compile(
-    r"""(?mx)
-        ^\*\s\[(?P<submission_title>.+)\]
-            \((?P<submission_url>http://www\.reddit\.com/r/changemyview/
-                comments/(?P<submission_id>\w+)/.+/)\)\s
-        \((?P<delta_count>\d)\)""")
-
-RE_USER_PAGE_V2_COMMENT = re.compile(
-    r"""(?mx)
-        ^\s+1\.\s\[Awarded\sby\s/u/(?P<awarded_by>\w+)\]
-            \((?P<comment_url>http://www\.reddit\.com/r/changemyview/comments/
-                \w+/.+/(?P<comment_id>\w+))\?context=2\)\s
-        on\s(?P<awarded_at>\d+/\d+/\d+)$""")
-
-
-def parse_user_page_v2(page_content, username):
-    parsed_deltas = []
+    Awardees are lowercased.  Only replies to comments count, like DeltaBot
+    did.
+    """
+    comments = dict((comment[0], comment) for comment in thread['comments'])
+    deltas = defaultdict(list)
+    for _, parent_id, author, _, body in thread['comments']:
+        if author != 'DeltaBot' or not parent_id.startswith('t1_'):
+            continue
+        parent = comments.get(parent_id[3:])
+        if parent is None:
+            continue
+        
+        parent_comment_id, _, parent_author, parent_created_utc, _ = parent
+        for username in RE_DELTA_CONFIRMATION.findall(body):
+            deltas[username.lower()].append(ParsedDelta(
+                awarded_at=datetime.fromtimestamp(parent_created_utc),
+                awarded_by=parent_author or '[deleted]',
+                awarder_comment_id=parent_comment_id,
+                awarder_comment_url=thread['url'] + parent_comment_id,
+                submission_id=thread['id'],
+                submission_title=thread['title'],
+                submission_url=thread['url']))
+    return deltas
+
+
+class ThreadCache(object):
+    """Deltas of the submissions searched, extracted once per submission
     
-    submission_matches = RE_USER_PAGE_V2_SUBMISSION.finditer(page_content)
-    submission_matches = list(submission_matches)
+    The fetched threads are also kept on disk, so that imports run again
+    don't fetch them again.  Safe to use from several threads, each with its
+    own PRAW client.
+    """
     
-    if not submission_matches:
-        if not page_content or '/r/PixelOrange' in page_content:
-            return []
-        parsed_deltas.extend(parse_user_page_v1(page_content, username))
+    def __init__(self, directory):
+        self.directory = directory
+        self._deltas = {}
+        self._locks = defaultdict(threading.Lock)
+        self._locks_lock = threading.Lock()
     
-    for i, submission_m in enumerate(submission_matches):
-        submission_id = submission_m.group('submission_id')
-        submission_title = submission_m.group('submission_title')
-        submission_url = submission_m.group('submission_url')
-        
-        substring_start = submission_m.end() + 1
-        if submission_m == submission_matches[-1]:
-            substring = page_content[substring_start:]
-        else:
-            substring_end = submission_matches[i + 1].start() - 1
-            substring = page_content[substring_start:substring_end]
-        
-        comment_matches = list(RE_USER_PAGE_V2_COMMENT.finditer(substring))
-        
-        if not comment_matches:
-            found_deltas = search_deltas_thread(submission_url, username)
-            parsed_deltas.extend(found_deltas)
-            
-            delta_count = int(submission_m.group('delta_count'))
-            if len(found_deltas) != delta_count:
-                warnings.warn('delta count is {}, found {}'
-                              .format(delta_count, len(found_deltas)))
+    def _get_thread(self, r, submission_id, submission_url):
+        filename = os.path.join(self.directory, submission_id + '.json')
+        try:
+            with open(filename) as f:
+                return json.load(f)
+        except IOError:  # not fetched yet
+            pass
         
-        for comment_m in comment_matches:
-            parsed_deltas.append(ParsedDelta(
-                awarded_at=parse_date(comment_m.group('awarded_at')),
-                awarded_by=comment_m.group('awarded_by'),
-                awarder_comment_id=comment_m.group('comment_id'),
-                awarder_comment_url=comment_m.group('comment_url'),
-                submission_id=submission_id,
-                submission_title=submission_title,
-                submission_url=submission_url))
-    
-    if not parsed_deltas:
-        warnings.warn('v2: no deltas')
+        thread = fetch_thread(r, submission_url)
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:  # made by another thread meanwhile
+                pass
+        write_json(filename, thread)
+        return thread
     
-    return parsed_deltas
+    def get_deltas(self, r, submission_url):
+        submission_id = RE_SUBMISSION_ID.search(submission_url).group(
+            'submission_id')
+        with self._locks_lock:
+            lock = self._locks[submission_id]
+        # Users of the same thread wait for it to be fetched once
+        with lock:
+            if submission_id not in self._deltas:
+                thread = self._get_thread(r, submission_id, submission_url)
+                self._deltas[submission_id] = extract_thread_deltas(thread)
+            return self._deltas[submission_id]
 
 
-RE_USER_PAGE_V1 = re.compile(
-    r"""(?mx)
-        ^\*\x20\[(?P<submission_title>.+)\]
-            \((?P<submission_url>http://www\.reddit.com/r/changemyview/
-                comments/(?P<submission_id>\w+)/.+/)""")
+threads = ThreadCache(THREADS_DIR)
 
 
-def parse_user_page_v1(page_content, username):
-    parsed_deltas = []
-    matches = list(RE_USER_PAGE_V1.finditer(page_content))
-    
-    for m in matches:
-        submission_url = m.group('submission_url')
-        parsed_deltas.extend(search_deltas_thread(submission_url, username))
-    
-    return parsed_deltas
+def search_deltas_thread(r, submission_url, awardee_username):
+    deltas = threads.get_deltas(r, submission_url)
+    return list(deltas.get(awardee_username.lower(), []))
 
 
-def process_user(username):
+def parse_user(r, username):
     parsed_deltas = []
-    
-    print 'Processing for /u/{}...'.format(username),
+    search_thread = partial(search_deltas_thread, r)
     
     page_v3 = r.get_wiki_page('changemyview', 'user/{}'.format(username))
-    parsed_deltas.extend(parse_user_page_v3(page_v3.content_md, username))
+    parsed_deltas.extend(parse_user_page(page_v3.content_md, username,
+                                         search_thread))
     
     link_old = '/r/ChangeMyView/wiki/userhistory/user/{}'.format(username)
     if link_old in page_v3.content_md:
         page_v2_name = 'userhistory/user/{}'.format(username)
         page_v2 = r.get_wiki_page('changemyview', page_v2_name)
-        parsed_deltas.extend(parse_user_page_v2(page_v2.content_md, username))
+        parsed_deltas.extend(parse_user_page_v2(page_v2.content_md, username,
+                                                search_thread))
     
-    for parsed_delta in parsed_deltas:
-        delta = to_ndb_delta(parsed_delta, username)
-        delta.put()
+    return parsed_deltas
+
+
+def fetch_user_deltas(username):
+    """Return a user's deltas, or None if their pages couldn't be fetched
     
-    print 'done ({} deltas)'.format(len(parsed_deltas))
+    Called from the worker threads.  PRAW clients aren't thread-safe, so each
+    thread uses its own.
+    """
+    attempts = 0
+    while attempts < FETCH_ATTEMPTS:
+        r = get_reddit()
+        try:
+            parsed_deltas = parse_user(r, username)
+        except RedditRateLimited as e:
+            # Not an attempt, the quota is only spent until it resets
+            time.sleep(get_reddit_backoff() or e.sleep_time)
+            continue
+        except HTTPError as e:
+            warnings.warn('/u/{}: {}'.format(username, e))
+        except OAuthInvalidToken:
+            # Refreshed by the next get_reddit(), once for all the threads
+            invalidate_access_info()
+        else:
+            return username, [to_ndb_delta(parsed_delta, username)
+                              for parsed_delta in parsed_deltas]
+        attempts += 1
+    return username, None
+
+
+def put_new_deltas(deltas):
+    """Store the deltas that don't exist yet and return how many there were
     
-    if len(parsed_deltas) == 0:
-        warnings.warn('no deltas')
+    Pages may list the same delta twice, hence keyed by awarder comment.
+    """
+    deltas = dict((delta.key, delta) for delta in deltas).values()
+    existing = ndb.get_multi([delta.key for delta in deltas])
+    new_deltas = [delta for delta, stored in zip(deltas, existing)
+                  if stored is None]
+    ndb.put_multi(new_deltas)
+    return len(new_deltas)
+
+
+def load_checkpoint(filename):
+    try:
+        with open(filename) as f:
+            return set(json.load(f))
+    except IOError:  # first run
+        return set()
+
+
+def save_checkpoint(filename, usernames):
+    write_json(filename, sorted(usernames))
 
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8,
+                        help='user pages fetched concurrently, default: 8')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILENAME,
+                        help='file of the users done, default: '
+                             '{}'.format(CHECKPOINT_FILENAME))
+    parser.add_argument('--restart', action='store_true',
+                        help='import every user again')
+    parser.add_argument('--threads-dir', default=THREADS_DIR,
+                        help='directory of the fetched threads, default: '
+                             '{}'.format(THREADS_DIR))
+    args = parser.parse_args()
+    threads.directory = args.threads_dir
+    
     print datetime.utcnow().isoformat()
     
     usernames = []
     
+    r = get_reddit()
     for user_page in r.get_wiki_pages('changemyview'):
         name = user_page.page
         if name.startswith('user/'):
             usernames.append(name[5:])
     
-    print '{} user pages'.format(len(usernames))
+    done = set() if args.restart else load_checkpoint(args.checkpoint)
+    todo = [username for username in usernames if username not in done]
+    print '{} user pages, {} left'.format(len(usernames), len(todo))
     
-    try:
-        i = int(sys.argv[1])
-    except IndexError:
-        i = 0
+    batch_deltas = []
+    batch_usernames = []
+    failed = []
+    new_count = 0
     
-    while i < len(usernames):
-        username = usernames[i] 
-        print '{}/{}...'.format(i, len(usernames) - 1)
-        try:
-            process_user(username)
-        except HTTPError:
-            pass
-        except OAuthInvalidToken:
-            r.refresh_access_information()
-        else:
-            i += 1
+    def flush():
+        count = put_new_deltas(batch_deltas)
+        done.update(batch_usernames)
+        save_checkpoint(args.checkpoint, done)
+        del batch_deltas[:]
+        del batch_usernames[:]
+        return count
+    
+    # Pages are fetched meanwhile the deltas are written
+    pool = ThreadPool(args.workers)
+    results = pool.imap_unordered(fetch_user_deltas, todo)
+    for i, (username, deltas) in enumerate(results, 1):
+        if deltas is None:
+            failed.append(username)
+            print '{}/{} /u/{}: failed'.format(i, len(todo), username)
+            continue
+        
+        print '{}/{} /u/{}: {} deltas'.format(i, len(todo), username,
+                                              len(deltas))
+        if not deltas:
+            warnings.warn('/u/{}: no deltas'.format(username))
+        
+        batch_deltas.extend(deltas)
+        batch_usernames.append(username)
+        if len(batch_deltas) >= PUT_BATCH_SIZE:
+            new_count += flush()
+    new_count += flush()
+    pool.close()
+    pool.join()
+    
+    print '{} new deltas'.format(new_count)
+    if new_count:
+        # Like /crons/rebuilduserstats
+        defer(rebuild_user_stats)
+        print 'User stats rebuild queued'
+    if failed:
+        print '{} users failed, run again to retry them: {}'.format(
+            len(failed), ', '.join(failed))
     
     print datetime.utcnow().isoformat()
 
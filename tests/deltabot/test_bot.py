@@ -1,14 +1,22 @@
 from datetime import datetime
+import json
+from operator import attrgetter
 import os
+import time
 import unittest
 
+from google.appengine.api import memcache
 from google.appengine.datastore import datastore_stub_util
-from google.appengine.ext import ndb
+from google.appengine.ext import deferred, ndb
 from mock import patch, MagicMock, Mock
+from webob import Request
 
+from application import tasks
+import application.deltabot
 from application.deltabot import config, utils
 from application.deltabot import bot
-from application.deltabot.models import Delta
+from application.deltabot.models import (Delta, KeyValueStore, PendingFlair,
+                                         UserStats)
 
 config.BOT_USERNAME = 'bot'
 config.DELTA = '+'
@@ -28,7 +36,9 @@ def _get_delta(**kwargs):
         'submission_url': 'http://example.com/submission',
     }
     defaults.update(**kwargs)
-    return utils.ndb_model(Delta, **defaults)
+    key = utils.delta_key(defaults['awarded_to'],
+                          defaults['awarder_comment_id'])
+    return Delta(key=key, **defaults)
 
 
 def _get_comment(**kwargs):
@@ -61,7 +71,23 @@ def _get_message(**kwargs):
     return message
 
 
-reddit_test = patch('application.deltabot.utils.praw.Reddit')
+ACCESS_INFO = {
+    'access_token': 'foo',
+    'refresh_token': 'bar',
+    'scope': set(['read']),
+}
+
+
+def _get_reddit_class():
+    utils.clear_reddit_cache()
+    reddit_class = MagicMock()
+    refresh = reddit_class.return_value.refresh_access_information
+    refresh.return_value = ACCESS_INFO
+    return reddit_class
+
+
+reddit_test = patch('application.deltabot.utils.praw.Reddit',
+                    new_callable=_get_reddit_class)
 defer_reddit_test = patch('application.deltabot.utils.defer_reddit',
                           side_effect=utils.defer_reddit)
 
@@ -90,6 +116,7 @@ class TaskQueueTestMixin(object):
 
 
 class DatastoreTestMixin(object):
+    nosegae_memcache = True
     nosegae_datastore_v3 = True
     nosegae_datastore_v3_kwargs = {
         'consistency_policy':
@@ -100,6 +127,299 @@ class DatastoreTestMixin(object):
         ndb.get_context().set_cache_policy(False)
 
 
+class GlobalQueryTestMixin(DatastoreTestMixin):
+    """For code relying on queries that aren't ancestor queries
+    
+    They're only eventually consistent, so writes are applied right away.
+    """
+    nosegae_datastore_v3_kwargs = {
+        'consistency_policy':
+            datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1),
+    }
+
+
+class TestDefaultSettings(unittest.TestCase):
+    @patch('application.deltabot.config.MODERATORS_CACHE_TTL', 1)
+    def test_missing_setting(self):
+        del config.MODERATORS_CACHE_TTL
+        reload(application.deltabot)
+        assert config.MODERATORS_CACHE_TTL == 600
+    
+    @patch('application.deltabot.config.MODERATORS_CACHE_TTL', 1)
+    def test_setting_kept(self):
+        reload(application.deltabot)
+        assert config.MODERATORS_CACHE_TTL == 1
+
+
+@reddit_test
+class TestGetReddit(unittest.TestCase, DatastoreTestMixin):
+    def store_access_info(self, access_token, expires_at):
+        access_info = dict(ACCESS_INFO, access_token=access_token,
+                           expires_at=expires_at, scope=['read'])
+        utils.KVStore_set('access_info', json.dumps(access_info))
+    
+    def test_refreshes_access_info(self, reddit_class):
+        r = utils.get_reddit()
+        assert r.refresh_access_information.called
+        r.set_access_credentials.assert_called_with(
+            set(['read']), 'foo', 'bar', update_user=False)
+        access_info = json.loads(utils.KVStore_get('access_info'))
+        assert access_info['access_token'] == 'foo'
+    
+    def test_reuses_client(self, reddit_class):
+        utils.get_reddit()
+        utils.get_reddit()
+        assert reddit_class.call_count == 1
+        r = reddit_class.return_value
+        assert r.refresh_access_information.call_count == 1
+        assert r.set_access_credentials.call_count == 1
+    
+    def test_uses_stored_access_info(self, reddit_class):
+        self.store_access_info('baz', time.time() + 60)
+        r = utils.get_reddit()
+        assert not r.refresh_access_information.called
+        r.set_access_credentials.assert_called_with(
+            set(['read']), 'baz', 'bar', update_user=False)
+    
+    def test_stored_access_info_expired(self, reddit_class):
+        self.store_access_info('baz', time.time() - 60)
+        r = utils.get_reddit()
+        assert r.refresh_access_information.called
+    
+    def test_stored_access_info_old_format(self, reddit_class):
+        utils.KVStore_set('access_info', str(ACCESS_INFO))
+        r = utils.get_reddit()
+        assert r.refresh_access_information.called
+    
+    @patch('application.deltabot.utils.time.sleep')
+    def test_waits_for_concurrent_refresh(self, sleep_func, reddit_class):
+        memcache.add('access_info_refresh_lock', 1)
+        sleep_func.side_effect = (
+            lambda _: self.store_access_info('baz', time.time() + 60))
+        
+        r = utils.get_reddit()
+        
+        assert not r.refresh_access_information.called
+        r.set_access_credentials.assert_called_with(
+            set(['read']), 'baz', 'bar', update_user=False)
+    
+    def test_invalidate_access_info(self, reddit_class):
+        utils.get_reddit()
+        utils.invalidate_access_info()
+        
+        r = utils.get_reddit()
+        
+        assert r.refresh_access_information.call_count == 2
+    
+    def test_invalidate_access_info_already_refreshed(self, reddit_class):
+        utils.get_reddit()
+        self.store_access_info('baz', time.time() + 60)
+        utils.invalidate_access_info()
+        
+        r = utils.get_reddit()
+        
+        assert r.refresh_access_information.call_count == 1
+        r.set_access_credentials.assert_called_with(
+            set(['read']), 'baz', 'bar', update_user=False)
+    
+    def test_handler_invalidates_access_info(self, reddit_class):
+        utils.get_reddit()
+        handler = utils.RedditHandler()
+        handler.http = Mock()
+        handler.http.send.return_value = Mock(status_code=401, headers={})
+        handler.request(**HANDLER_REQUEST_KWARGS)
+        
+        r = utils.get_reddit()
+        
+        assert r.refresh_access_information.call_count == 2
+
+
+HANDLER_REQUEST_KWARGS = {
+    'request': Mock(),
+    'proxies': None,
+    'timeout': None,
+    '_cache_key': ('https://oauth.reddit.com/foo', None),
+    '_cache_ignore': False,
+    '_cache_timeout': 30,
+    '_rate_domain': 'oauth.reddit.com',
+    '_rate_delay': 2,
+}
+
+
+class TestRedditRateLimit(unittest.TestCase, DatastoreTestMixin,
+                          TaskQueueTestMixin):
+    def setUp(self):
+        self.now = 1000
+        self.sleeps = []
+        
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+        
+        patchers = [
+            patch('application.deltabot.utils.time.time',
+                  side_effect=lambda: self.now),
+            patch('application.deltabot.utils.time.sleep',
+                  side_effect=sleep),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+    
+    def store_ratelimit(self, remaining, reset):
+        response = Mock(headers={'X-Ratelimit-Remaining': str(remaining),
+                                 'X-Ratelimit-Reset': str(reset)})
+        utils._store_ratelimit(response)
+    
+    def test_default_rate(self):
+        utils._acquire_reddit_token()
+        utils._acquire_reddit_token()
+        assert self.sleeps == [1.0]
+    
+    def test_burst(self):
+        self.store_ratelimit(310, 100)  # 3 requests/s once the reserve kept
+        for _ in range(config.REDDIT_BURST_SIZE):
+            utils._acquire_reddit_token()
+        assert self.sleeps == []
+        
+        utils._acquire_reddit_token()
+        assert self.sleeps == [1 / 3.0]
+    
+    def test_spent(self):
+        self.store_ratelimit(config.REDDIT_RATELIMIT_RESERVE, 5)
+        utils._acquire_reddit_token()
+        assert self.sleeps == [5]
+    
+    def test_spent_meanwhile_reset(self):
+        with patch('application.deltabot.utils._get_reddit_quota',
+                   side_effect=[(0, 0, self.now - 0.1), (1.0, 1, None)]):
+            utils._acquire_reddit_token()
+        assert self.sleeps == [0]
+    
+    @patch.dict('application.deltabot.utils.DefaultHandler.cache')
+    @patch.dict('application.deltabot.utils.DefaultHandler.timeouts')
+    def test_cached_responses_free(self):
+        handler = utils.RedditHandler()
+        handler.http = Mock()
+        handler.http.send.return_value = Mock(
+            status_code=200, headers={'X-Ratelimit-Remaining': '100',
+                                      'X-Ratelimit-Reset': '100'})
+        handler.request(**HANDLER_REQUEST_KWARGS)
+        self.store_ratelimit(50, 10)
+        ratelimit = memcache.get(utils._RATELIMIT_KEY)
+        
+        with patch('application.deltabot.utils._acquire_reddit_token') as \
+                acquire_token_func:
+            handler.request(**HANDLER_REQUEST_KWARGS)
+        
+        assert handler.http.send.call_count == 1
+        assert not acquire_token_func.called
+        assert memcache.get(utils._RATELIMIT_KEY) == ratelimit
+    
+    def test_spent_for_long(self):
+        self.store_ratelimit(0, 300)
+        with self.assertRaises(utils.RedditRateLimited) as cm:
+            utils._acquire_reddit_token()
+        assert cm.exception.sleep_time == 300
+        assert self.sleeps == []
+    
+    def test_spent_for_long_task_retried(self):
+        self.store_ratelimit(0, 300)
+        request = Request.blank('/_ah/queue/deferred',
+                                environ={'SERVER_SOFTWARE': 'Development'},
+                                headers={'X-AppEngine-TaskName': 'foo'},
+                                POST=deferred.serialize(
+                                    utils._acquire_reddit_token))
+        response = request.get_response(tasks.app)
+        assert response.status_int == 408
+    
+    def test_defer_reddit_delayed(self):
+        utils.defer_reddit(PickableMock())
+        self.store_ratelimit(0, 300)
+        utils.defer_reddit(PickableMock())
+        assert [task.eta_posix for task in self.get_tasks()] == [1000, 1300]
+    
+    def test_lanes(self):
+        utils.defer_reddit(PickableMock())
+        utils.defer_reddit(PickableMock(), _lane='bulk')
+        utils.defer_reddit_coalesced('foo', PickableMock(), _lane='flair')
+        utils.defer_reddit(PickableMock(), _lane='consumers')
+        stub = self.testbed.get_stub('taskqueue')
+        for queue_name in ('reddit', 'reddit-bulk', 'reddit-flair',
+                           'reddit-consumers'):
+            assert len(stub.get_filtered_tasks(queue_names=queue_name)) == 1
+    
+    def test_lower_lanes_leave_tokens(self):
+        self.store_ratelimit(310, 100)
+        with patch.dict(os.environ,
+                        {'HTTP_X_APPENGINE_QUEUENAME': 'reddit-bulk'}):
+            for _ in range(3):
+                utils._acquire_reddit_token()
+            assert self.sleeps == []
+            utils._acquire_reddit_token()
+            assert len(self.sleeps) == 1
+        
+        # The interactive lane gets what the bulk lane left
+        for _ in range(6):
+            utils._acquire_reddit_token()
+        assert len(self.sleeps) == 1
+
+
+@reddit_test
+class TestGetModeratorUsernames(unittest.TestCase, DatastoreTestMixin):
+    def setUp(self):
+        utils.invalidate_moderators_cache('testsub')
+    
+    def get_moderators(self, reddit_class):
+        get_moderators = reddit_class.return_value.get_moderators
+        get_moderators.return_value = [Mock(), Mock()]
+        get_moderators.return_value[0].name = 'john'
+        get_moderators.return_value[1].name = 'jane'
+        return get_moderators
+    
+    def test_usernames(self, reddit_class):
+        self.get_moderators(reddit_class)
+        usernames = utils.get_moderator_usernames('testsub')
+        assert usernames == set(['john', 'jane'])
+    
+    def test_cached(self, reddit_class):
+        get_moderators = self.get_moderators(reddit_class)
+        utils.get_moderator_usernames('testsub')
+        utils.get_moderator_usernames('testsub')
+        assert get_moderators.call_count == 1
+    
+    def test_cached_in_memcache(self, reddit_class):
+        get_moderators = self.get_moderators(reddit_class)
+        utils.get_moderator_usernames('testsub')
+        utils._moderators.clear()
+        utils.get_moderator_usernames('testsub')
+        assert get_moderators.call_count == 1
+    
+    def test_instance_copy_expired(self, reddit_class):
+        get_moderators = self.get_moderators(reddit_class)
+        utils.get_moderator_usernames('testsub')
+        memcache.flush_all()
+        with patch('application.deltabot.utils.time.time',
+                   return_value=time.time() + utils._MODERATORS_INSTANCE_TTL):
+            utils.get_moderator_usernames('testsub')
+        assert get_moderators.call_count == 2
+    
+    def test_expired(self, reddit_class):
+        get_moderators = self.get_moderators(reddit_class)
+        utils.get_moderator_usernames('testsub')
+        with patch('application.deltabot.utils.time.time',
+                   return_value=time.time() + config.MODERATORS_CACHE_TTL):
+            utils.get_moderator_usernames('testsub')
+        assert get_moderators.call_count == 2
+    
+    def test_invalidated(self, reddit_class):
+        get_moderators = self.get_moderators(reddit_class)
+        utils.get_moderator_usernames('testsub')
+        utils.invalidate_moderators_cache('testsub')
+        utils.get_moderator_usernames('testsub')
+        assert get_moderators.call_count == 2
+
+
 class TestQueryUserDeltas(unittest.TestCase, DatastoreTestMixin):
     def setUp(self):
         self.delta = _get_delta(awarded_to='john')
@@ -115,23 +435,221 @@ class TestQueryUserDeltas(unittest.TestCase, DatastoreTestMixin):
         assert bot._query_user_deltas('john').count() == 0
 
 
+class TestIndexes(unittest.TestCase, DatastoreTestMixin):
+    """Queries fail without their index in index.yaml, like in production"""
+    nosegae_datastore_v3_kwargs = {
+        'require_indexes': True,
+        'root_path': os.path.join(os.path.dirname(__file__), '../..'),
+    }
+    
+    def test_user_deltas(self):
+        bot._query_user_deltas('john').fetch()
+    
+    def test_already_awarded(self):
+        utils.query_delta(Delta.awarded_by == 'John',
+                          Delta.submission_id == 'x',
+                          ancestor=utils.user_key('Jane'),
+                          include_removed=False).get()
+    
+    def test_legacy_awarded(self):
+        assert not bot._is_legacy_awarded('John', 'Jane', 'x')
+
+
+@reddit_test
+class TestGetThings(unittest.TestCase, DatastoreTestMixin):
+    def test_batched(self, reddit_class):
+        get_info = reddit_class.return_value.get_info
+        get_info.side_effect = lambda thing_id: [
+            Mock(fullname=fullname) for fullname in thing_id
+            if fullname != 't1_1']
+        fullnames = ['t1_{}'.format(i) for i in range(150)]
+        
+        things = utils.get_things(fullnames + ['t1_0'])
+        
+        assert get_info.call_count == 2
+        assert len(things) == 149
+        assert things['t1_0'].fullname == 't1_0'
+        assert 't1_1' not in things
+    
+    def test_nothing(self, reddit_class):
+        assert utils.get_things([]) == {}
+        assert not reddit_class.return_value.get_info.called
+
+
+class TestGetUserStats(unittest.TestCase, DatastoreTestMixin):
+    def setUp(self):
+        self.delta1 = _get_delta(awarded_at=datetime(1970, 1, 1),
+                                 awarded_to='john',
+                                 awarder_comment_id='1',
+                                 awarder_comment_url='http://example.com/1')
+        self.delta2 = _get_delta(awarded_at=datetime(1970, 1, 2),
+                                 awarded_to='john',
+                                 awarder_comment_id='2',
+                                 awarder_comment_url='http://example.com/2')
+        self.delta3 = _get_delta(awarded_to='john', awarder_comment_id='3',
+                                 status='removed_abuse')
+        ndb.put_multi([self.delta1, self.delta2, self.delta3])
+    
+    def test_stored(self):
+        UserStats(id='john', delta_count=5).put()
+        assert bot._get_user_stats('john').delta_count == 5
+    
+    def test_computed(self):
+        stats = bot._get_user_stats('john')
+        assert stats.delta_count == 2
+        assert stats.last_awarded_at == datetime(1970, 1, 2)
+        assert stats.last_awarder_comment_url == 'http://example.com/2'
+    
+    def test_computed_no_deltas(self):
+        stats = bot._get_user_stats('jane')
+        assert stats.delta_count == 0
+        assert stats.last_awarded_at is None
+    
+    def test_computed_excluded_delta(self):
+        stats = bot._compute_user_stats('john', self.delta2.key)
+        assert stats.delta_count == 1
+        assert stats.last_awarded_at == datetime(1970, 1, 1)
+
+
+class TestRebuildUserStats(unittest.TestCase, GlobalQueryTestMixin,
+                           TaskQueueTestMixin):
+    def test_rebuild(self):
+        _get_delta(awarded_to='john').put()
+        UserStats(id='john', delta_count=5).put()
+        UserStats(id='jane', delta_count=1).put()
+        
+        bot.rebuild_user_stats()
+        
+        assert UserStats.get_by_id('john').delta_count == 1
+        assert UserStats.get_by_id('jane').delta_count == 0
+    
+    @patch('application.deltabot.bot.REBUILD_BATCH_SIZE', 1)
+    def test_rebuild_batches(self):
+        _get_delta(awarded_to='john').put()
+        _get_delta(awarded_to='jane').put()
+        
+        bot.rebuild_user_stats()
+        
+        assert UserStats.get_by_id('john').delta_count == 1
+        assert UserStats.get_by_id('jane').delta_count == 1
+    
+    @patch('application.deltabot.utils.defer_reddit')
+    def test_tracker_updated(self, defer_func):
+        bot.rebuild_user_stats()
+        defer_func.assert_called_with(bot.update_tracker_wiki_page,
+                                      _lane='bulk')
+    
+    @patch('application.deltabot.utils.defer_reddit_coalesced')
+    def test_wrong_users_updated(self, defer_func):
+        delta = _get_delta(awarded_to='john')
+        delta.put()
+        _get_delta(awarded_to='jane').put()
+        # As left by an update before the migration moved the others
+        UserStats(id='john', delta_count=5).put()
+        bot._rebuild_user_stats_async('jane').get_result()
+        
+        bot.rebuild_user_stats()
+        
+        assert [key.id() for key in PendingFlair.query().iter(
+            keys_only=True)] == ['john']
+        defer_func.assert_any_call('user-wiki-john',
+                                   bot.update_user_wiki_page, 'john',
+                                   _lane='bulk')
+        assert defer_func.call_count == 2
+
+
+class TestQueueUserFlair(unittest.TestCase, GlobalQueryTestMixin,
+                         TaskQueueTestMixin):
+    def test_queued(self):
+        bot.queue_user_flair('john')
+        bot.queue_user_flair('jane')
+        assert PendingFlair.query().count() == 2
+        assert len(self.get_tasks()) == 1
+
+
 @reddit_test
-class TestUpdateUserFlair(unittest.TestCase, DatastoreTestMixin):
+class TestFlushFlairOutbox(unittest.TestCase, GlobalQueryTestMixin,
+                           TaskQueueTestMixin):
     def setUp(self):
         self.delta = _get_delta(awarded_to='john')
         self.delta.put()
+        UserStats(id='mary', delta_count=3).put()
+        ndb.put_multi([PendingFlair(id='jane'),
+                       PendingFlair(id='john'),
+                       PendingFlair(id='mary')])
+    
+    def set_results(self, reddit_class, *oks):
+        set_flair_csv = reddit_class.return_value.set_flair_csv
+        set_flair_csv.return_value = [{'ok': ok, 'errors': {}} for ok in oks]
+        return set_flair_csv
+    
+    def test_flairs_sent(self, reddit_class):
+        set_flair_csv = self.set_results(reddit_class, True, True, True)
+        bot.flush_flair_outbox()
+        set_flair_csv.assert_called_with(config.SUBREDDIT, [
+            {'user': 'jane', 'flair_text': ''},
+            {'user': 'john', 'flair_text': '1+'},
+            {'user': 'mary', 'flair_text': '3+'},
+        ])
+        assert PendingFlair.query().count() == 0
+        assert len(self.get_tasks()) == 0
+    
+    def test_failed_flairs_retried(self, reddit_class):
+        self.set_results(reddit_class, True, False, True)
+        
+        bot.flush_flair_outbox()
+        
+        pending_flairs = PendingFlair.query().fetch()
+        assert [flair.key.id() for flair in pending_flairs] == ['john']
+        assert pending_flairs[0].attempts == 1
+        assert len(self.get_tasks()) == 1
+    
+    def test_failed_flairs_given_up(self, reddit_class):
+        self.set_results(reddit_class, True, False, True)
+        flair = ndb.Key(PendingFlair, 'john').get()
+        flair.attempts = bot.FLAIR_MAX_ATTEMPTS - 1
+        flair.put()
+        
+        bot.flush_flair_outbox()
+        
+        assert PendingFlair.query().count() == 0
+    
+    def test_queued_again_while_sending(self, reddit_class):
+        set_flair_csv = self.set_results(reddit_class, True, True, True)
+        results = set_flair_csv.return_value
+        
+        def queue_again(*args):
+            PendingFlair(id='john').put()
+            return results
+        set_flair_csv.side_effect = queue_again
+        
+        bot.flush_flair_outbox()
+        
+        pending_flairs = PendingFlair.query().fetch()
+        assert [flair.key.id() for flair in pending_flairs] == ['john']
     
-    def test_delta_count_non_null(self, reddit_class):
-        bot.update_user_flair('john')
-        assert reddit_class.return_value.set_flair.called
+    def test_nothing_pending(self, reddit_class):
+        ndb.delete_multi(PendingFlair.query().fetch(keys_only=True))
+        bot.flush_flair_outbox()
+        assert not reddit_class.return_value.set_flair_csv.called
     
-    def test_delta_count_null(self, reddit_class):
-        bot.update_user_flair('jane')
-        assert reddit_class.return_value.delete_flair.called
+    def test_unchanged_flairs_not_sent(self, reddit_class):
+        self.set_results(reddit_class, True, True, True)
+        bot.flush_flair_outbox()
+        ndb.put_multi([PendingFlair(id='john'), PendingFlair(id='mary')])
+        UserStats(id='mary', delta_count=4).put()
+        
+        set_flair_csv = self.set_results(reddit_class, True)
+        bot.flush_flair_outbox()
+        
+        set_flair_csv.assert_called_with(config.SUBREDDIT, [
+            {'user': 'mary', 'flair_text': '4+'},
+        ])
+        assert PendingFlair.query().count() == 0
 
 
 @reddit_test
-class TestUpdateSubmissionFlair(unittest.TestCase, DatastoreTestMixin):
+class TestUpdateSubmissionFlair(unittest.TestCase, GlobalQueryTestMixin):
     def setUp(self):
         self.comment = _get_comment()
         self.comment.submission = Mock(id='x')
@@ -156,18 +674,59 @@ class TestUpdateSubmissionFlair(unittest.TestCase, DatastoreTestMixin):
         set_flair = reddit_class.return_value.set_flair
         set_flair.assert_called_with(config.SUBREDDIT, self.comment.submission,
                                      None, None)
+    
+    def test_unchanged_not_set(self, reddit_class):
+        self.comment.submission.author.name = 'John'
+        
+        bot.update_submission_flair(self.comment)
+        bot.update_submission_flair(self.comment)
+        
+        assert reddit_class.return_value.set_flair.call_count == 1
 
 
-class TestGetUserDeltas(unittest.TestCase, DatastoreTestMixin):
+class TestGetUserHistoryRows(unittest.TestCase, DatastoreTestMixin):
     def setUp(self):
         self.delta1 = _get_delta(awarded_at=datetime(1970, 1, 1),
-                                 awarded_to='john')
+                                 awarded_to='john', awarder_comment_id='1',
+                                 submission_title='foo')
         self.delta2 = _get_delta(awarded_at=datetime(1970, 1, 2),
-                                 awarded_to='john')
+                                 awarded_to='john', awarder_comment_id='2',
+                                 submission_title='bar')
         ndb.put_multi([self.delta1, self.delta2])
     
-    def test_is_sorted(self):
-        assert bot._get_user_deltas('john') == [self.delta2, self.delta1]
+    def get_titles(self):
+        return [row_md.split(' | ')[1]
+                for row_md in bot._get_user_history_rows('john')]
+    
+    @patch('application.deltabot.bot._render_user_history_row',
+           wraps=bot._render_user_history_row)
+    def test_rows_cached(self, render_row_func):
+        assert self.get_titles() == ['bar', 'foo']
+        assert self.get_titles() == ['bar', 'foo']
+        assert render_row_func.call_count == 2
+    
+    @patch('application.deltabot.bot._render_user_history_row',
+           wraps=bot._render_user_history_row)
+    def test_only_new_rows_rendered(self, render_row_func):
+        self.get_titles()
+        _get_delta(awarded_at=datetime(1970, 1, 3), awarded_to='john',
+                   awarder_comment_id='3', submission_title='baz').put()
+        assert self.get_titles() == ['baz', 'bar', 'foo']
+        assert render_row_func.call_count == 3
+    
+    def test_removed_rows_dropped(self):
+        self.get_titles()
+        self.delta2.status = 'removed_abuse'
+        self.delta2.put()
+        assert self.get_titles() == ['foo']
+    
+    @patch('application.deltabot.bot._render_user_history_row',
+           wraps=bot._render_user_history_row)
+    def test_rendered_again_on_version_change(self, render_row_func):
+        self.get_titles()
+        with patch('application.deltabot.bot.USER_HISTORY_SCHEMA', 0):
+            assert self.get_titles() == ['bar', 'foo']
+        assert render_row_func.call_count == 4
 
 
 @reddit_test
@@ -175,27 +734,128 @@ class TestUpdateUserWikiPage(unittest.TestCase, DatastoreTestMixin):
     def test_edit_wiki_page_called(self, reddit_class):
         bot.update_user_wiki_page('john')
         assert reddit_class.return_value.edit_wiki_page.called
+    
+    def test_unchanged_not_edited(self, reddit_class):
+        edit_wiki_page = reddit_class.return_value.edit_wiki_page
+        bot.update_user_wiki_page('john')
+        bot.update_user_wiki_page('john')
+        assert edit_wiki_page.call_count == 1
+        
+        _get_delta(awarded_to='john').put()
+        bot.update_user_wiki_page('john')
+        assert edit_wiki_page.call_count == 2
 
 
-class TestGetDeltasGroupedByUsers(unittest.TestCase, DatastoreTestMixin):
+class TestGetTrackerUsers(unittest.TestCase, GlobalQueryTestMixin):
     def setUp(self):
-        self.delta1 = _get_delta(awarded_at=datetime(1970, 1, 1),
-                                 awarded_to='john')
-        self.delta2 = _get_delta(awarded_at=datetime(1970, 1, 2),
-                                 awarded_to='john')
-        self.delta3 = _get_delta(awarded_at=datetime(1970, 1, 1),
-                                 awarded_to='mary')
-        ndb.put_multi([self.delta1, self.delta2, self.delta3])
+        self.stats1 = UserStats(id='mary', delta_count=1)
+        self.stats2 = UserStats(id='john', delta_count=2)
+        self.stats3 = UserStats(id='jane', delta_count=0)
+        ndb.put_multi([self.stats1, self.stats2, self.stats3])
+    
+    def test_is_sorted(self):
+        assert bot._get_tracker_users() == [self.stats2, self.stats1]
+    
+    def test_shard(self):
+        stats = UserStats(id='Mike', delta_count=1)
+        stats.put()
+        assert bot._get_tracker_users('m') == [self.stats1, stats]
+        assert bot._get_tracker_users('j') == [self.stats2]
     
-    def test_is_grouped(self):
-        assert bot._get_deltas_grouped_by_users() == [self.delta2, self.delta3]
+    def test_other_shard(self):
+        stats = [UserStats(id=username, delta_count=1)
+                 for username in ('-a', '9z', '_b', 'Z', 'z')]
+        ndb.put_multi(stats)
+        assert bot._get_tracker_users('other') == stats[:3]
+
+
+class TestGetTrackerShard(unittest.TestCase):
+    def test_letter(self):
+        assert bot.get_tracker_shard('john') == 'j'
+        assert bot.get_tracker_shard('John') == 'j'
+    
+    def test_other(self):
+        assert bot.get_tracker_shard('_john') == 'other'
+        assert bot.get_tracker_shard('9john') == 'other'
 
 
 @reddit_test
-class TestUpdateTrackerWikiPage(unittest.TestCase, DatastoreTestMixin):
+class TestUpdateTrackerWikiPage(unittest.TestCase, GlobalQueryTestMixin):
+    def get_edited_pages(self, reddit_class):
+        edit_wiki_page = reddit_class.return_value.edit_wiki_page
+        return [args[1] for args, kwargs in edit_wiki_page.call_args_list]
+    
     def test_edit_wiki_page_called(self, reddit_class):
         bot.update_tracker_wiki_page()
         assert reddit_class.return_value.edit_wiki_page.called
+    
+    def test_all_pages(self, reddit_class):
+        UserStats(id='john', delta_count=1,
+                  last_awarded_at=datetime(1970, 1, 1)).put()
+        bot.update_tracker_wiki_page()
+        pages = self.get_edited_pages(reddit_class)
+        assert len(pages) == len(bot.TRACKER_SHARDS) + 1
+        assert 'deltabot/tracker' in pages
+        assert 'deltabot/tracker/j' in pages
+    
+    @patch('application.deltabot.utils.defer_reddit_coalesced')
+    def test_shard(self, defer_func, reddit_class):
+        bot.update_tracker_wiki_page('j')
+        assert self.get_edited_pages(reddit_class) == ['deltabot/tracker/j']
+        defer_func.assert_called_once_with('tracker-index',
+                                           bot.update_tracker_index,
+                                           _lane='bulk')
+    
+    @patch('application.deltabot.utils.defer_reddit_coalesced')
+    def test_shard_unchanged(self, defer_func, reddit_class):
+        bot.update_tracker_wiki_page('j')
+        defer_func.reset_mock()
+        bot.update_tracker_wiki_page('j')
+        assert not defer_func.called
+    
+    def test_index(self, reddit_class):
+        bot.update_tracker_index()
+        assert self.get_edited_pages(reddit_class) == ['deltabot/tracker']
+    
+    def test_unchanged_pages_skipped(self, reddit_class):
+        bot.update_tracker_wiki_page()
+        UserStats(id='john', delta_count=1,
+                  last_awarded_at=datetime(1970, 1, 1)).put()
+        reddit_class.return_value.edit_wiki_page.reset_mock()
+        bot.update_tracker_wiki_page()
+        assert self.get_edited_pages(reddit_class) == ['deltabot/tracker/j']
+
+
+@patch('application.deltabot.utils.defer_reddit_coalesced')
+class TestQueueRedditUpdates(unittest.TestCase):
+    @patch('application.deltabot.bot.queue_user_flair')
+    def test_updates_coalesced(self, queue_user_flair_func, defer_func):
+        comment = _get_comment(link_id='t3_x')
+        bot.queue_reddit_updates(comment, 'john')
+        defer_func.assert_any_call('submission-flair-x',
+                                   bot.update_submission_flair, comment,
+                                   _lane='flair')
+        defer_func.assert_any_call('user-wiki-john',
+                                   bot.update_user_wiki_page, 'john',
+                                   _lane='bulk')
+        defer_func.assert_any_call('tracker-j', bot.update_tracker_wiki_page,
+                                   'j', _lane='bulk')
+        queue_user_flair_func.assert_called_with('john')
+
+
+class TestDeferCoalesced(unittest.TestCase, TaskQueueTestMixin):
+    @patch('application.deltabot.utils.time.time', return_value=90)
+    def test_runs_at_end_of_window(self, time_func):
+        utils.defer_coalesced('foo', PickableMock())
+        task = self.get_tasks()[0]
+        assert task.name == 'foo-1'
+        assert task.eta_posix == 120
+    
+    def test_coalesced(self):
+        utils.defer_coalesced('foo', PickableMock())
+        utils.defer_coalesced('foo', PickableMock())
+        utils.defer_coalesced('bar', PickableMock())
+        assert len(self.get_tasks()) == 2
 
 
 @defer_reddit_test
@@ -223,16 +883,15 @@ class TestCommentProcessor(unittest.TestCase, DatastoreTestMixin,
         bot.CommentProcessor._reply_to_message(self.processor, None)
         assert self.message.reply.called
     
-    def test_update_reddit(self, reddit_class, defer_func):
+    @patch('application.deltabot.utils.defer')
+    def test_update_reddit(self, defer_func, reddit_class, defer_reddit_func):
         self.processor._awardee_comment = PickableMock()
         self.processor._awardee_comment.author.name = 'john'
         
         bot.CommentProcessor._update_reddit(self.processor)
         
-        defer_func.assert_any_call(bot.update_submission_flair,
-                                   self.awarder_comment)
-        defer_func.assert_any_call(bot.update_user_flair, 'john')
-        defer_func.assert_any_call(bot.update_user_wiki_page, 'john')
+        defer_func.assert_called_with(bot.queue_reddit_updates,
+                                      self.awarder_comment, 'john')
 
 
 @reddit_test
@@ -281,6 +940,14 @@ class TestDeltaAdder(unittest.TestCase, DatastoreTestMixin,
         
         assert self.processor._check_processable() == 'already_awarded'
     
+    def test_check_processable_already_awarded_legacy(self, reddit_class):
+        Delta(parent=bot._LEGACY_ANCESTOR,
+              **_get_delta(awarded_by='John',
+                           awarded_to='Jane',
+                           submission_id='x').to_dict()).put()
+        
+        assert self.processor._check_processable() == 'already_awarded'
+    
     def test_check_processable_toplevel_comment(self, reddit_class):
         self.processor._awarder_comment.is_root = True
         assert self.processor._check_processable() == 'toplevel_comment'
@@ -309,7 +976,7 @@ class TestDeltaAdder(unittest.TestCase, DatastoreTestMixin,
     def test_update_records(self, reddit_class):
         self.processor._update_records()
         
-        delta = utils.ndb_query(Delta).get()
+        delta = utils.delta_key('Jane', 'y').get()
         
         assert delta.awarded_at == datetime(1970, 1, 1)
         assert delta.awarded_by == 'John'
@@ -319,6 +986,17 @@ class TestDeltaAdder(unittest.TestCase, DatastoreTestMixin,
                                              'testsub/comments/x/_/y')
         assert delta.submission_id == 'x'
         assert delta.submission_title == 'Foo'
+    
+    def test_update_records_updates_stats(self, reddit_class):
+        UserStats(id='Jane', delta_count=1).put()
+        self.processor._update_records()
+        
+        stats = UserStats.get_by_id('Jane')
+        
+        assert stats.delta_count == 2
+        assert stats.last_awarded_at == datetime(1970, 1, 1)
+        assert stats.last_awarder_comment_url == ('https://www.reddit.com/r/'
+                                                  'testsub/comments/x/_/y')
 
 
 class TestHasDeltaToken(unittest.TestCase):
@@ -366,6 +1044,17 @@ class TestHasDeltaToken(unittest.TestCase):
         assert not self.check('\t+\nfoo')  # next line not empty
         
         assert self.check('\tfoo\n+')  # delta out of code
+    
+    def test_blank_lines(self):
+        assert self.check('>foo\n \n+')  # whitespace-only line ends quote
+        assert self.check('`foo\n\n+`')  # inline code within a paragraph
+        assert self.check('+\n>foo')  # text before the quote is kept
+    
+    def test_linear_time(self):
+        # Would take ages if any step backtracked
+        assert not self.check('\n\n    ' + '\n    x' * 50000 + '\n    +')
+        assert not self.check('>' + 'x\n' * 50000 + '+')
+        assert self.check('`' * 50000 + '+')
 
 
 @reddit_test
@@ -378,7 +1067,7 @@ class TestDeltaApprover(unittest.TestCase, DatastoreTestMixin,
         
         self.delta = _get_delta(awarder_comment_id='a')
         self.delta.put()
-        
+    
     def test_check_queuable(self, reddit_class):
         assert self.processor._check_queuable() is None
     
@@ -402,6 +1091,36 @@ class TestDeltaApprover(unittest.TestCase, DatastoreTestMixin,
         assert self.delta.status == 'approved'
 
 
+@reddit_test
+class TestStoredDelta(unittest.TestCase, GlobalQueryTestMixin):
+    def setUp(self):
+        self.processor = bot.CommentProcessor(_get_comment(id='a'))
+        self.processor._awardee_comment = _get_comment()
+        
+        self.delta = _get_delta(awarded_to='John', awarder_comment_id='a')
+        self.delta.put()
+    
+    def test_by_key(self, reddit_class):
+        assert self.processor._stored_delta == self.delta
+    
+    def test_awardee_comment_deleted(self, reddit_class):
+        self.processor._awardee_comment.author = None
+        assert self.processor._stored_delta == self.delta
+    
+    def test_awardee_comment_gone(self, reddit_class):
+        self.processor._awardee_comment = None
+        assert self.processor._stored_delta == self.delta
+    
+    def test_other_awardee_in_transaction(self, reddit_class):
+        self.processor._awardee_comment.author.name = 'Jane'
+        stored_delta = ndb.transaction(lambda: self.processor._stored_delta)
+        assert stored_delta == self.delta
+    
+    def test_no_record(self, reddit_class):
+        self.delta.key.delete()
+        assert self.processor._stored_delta is None
+
+
 @reddit_test
 class TestDeltaRemover(unittest.TestCase, DatastoreTestMixin,
                        TaskQueueTestMixin):
@@ -435,6 +1154,11 @@ class TestDeltaRemover(unittest.TestCase, DatastoreTestMixin,
     def test_update_records(self, reddit_class):
         self.processor._update_records()
         assert self.delta.status == 'removed_abuse'
+    
+    def test_update_records_updates_stats(self, reddit_class):
+        UserStats(id='John', delta_count=1).put()
+        self.processor._update_records()
+        assert UserStats.get_by_id('John').delta_count == 0
 
 
 @reddit_test
@@ -461,6 +1185,13 @@ class TestCommandMessageProcessor(unittest.TestCase):
     def test_check_queuable_not_incoming(self, reddit_class):
         self.processor._message.dest = '#subreddit'
         assert self.processor._check_queuable() == 'not_incoming'
+    
+    @patch('application.deltabot.utils.get_moderator_usernames',
+           return_value=set(['jane']))
+    def test_check_processable_not_a_mod(self, moderators_func,
+                                         reddit_class):
+        assert self.processor._check_processable() == 'not_a_mod'
+        moderators_func.assert_called_with('testsub')
 
 
 class ItemsConsumerMock(bot.ItemsConsumer):
@@ -468,7 +1199,8 @@ class ItemsConsumerMock(bot.ItemsConsumer):
     
     PROCESSOR = PickableMock()
     PLACEHOLDER_KEY = 'foos_placeholder'
-    PROCESSED_KEY = 'foos_processed:{}'
+    PROCESSED_KEY = 'foos'
+    FULLNAME_PREFIX = 't0_'
 
 
 class TestItemsConsumer(unittest.TestCase, DatastoreTestMixin,
@@ -476,29 +1208,116 @@ class TestItemsConsumer(unittest.TestCase, DatastoreTestMixin,
     def setUp(self):
         super(TestItemsConsumer, self).setUp()
         self.consumer = ItemsConsumerMock()
+        self.consumer.PROCESSOR.reset_mock()
+    
+    def get_item(self, **kwargs):
+        defaults = {'id': 'a', 'created_utc': time.time()}
+        defaults.update(kwargs)
+        return Mock(**defaults)
     
     def test_iter_items(self):
         items_list = [Mock(id='a', created_utc=0), Mock(id='b', created_utc=1)]
+        self.consumer._placeholder = None
         self.consumer._fetch_items = Mock(return_value=reversed(items_list))
         returned_items_list = list(self.consumer._iter_items())
         assert returned_items_list == items_list
     
-    def test_process_item_updates_placeholder(self):
-        self.consumer._process_item(Mock(id='a'))
-        assert utils.KVStore_get('foos_placeholder') == 'a'
+    def test_iter_items_reordered(self):
+        items_list = [Mock(id='a', created_utc=1), Mock(id='b', created_utc=0)]
+        self.consumer._placeholder = None
+        self.consumer._fetch_items = Mock(return_value=reversed(items_list))
+        returned_items_list = list(self.consumer._iter_items())
+        assert returned_items_list == items_list[::-1]
     
-    def test_process_item_updates_processed(self):
-        self.consumer._process_item(Mock(id='a'))
-        assert utils.KVStore_exists('foos_processed:a')
+    @patch('application.deltabot.bot.LISTING_PAGE_SIZE', 2)
+    def test_iter_items_paged(self):
+        items = dict((id, Mock(id=id, created_utc=int(id, 36)))
+                     for id in 'abcde')
+        pages = {
+            'a': [items['c'], items['b']],
+            'c': [items['e'], items['d']],
+            # Not full, so PRAW goes on with the older items
+            'e': [items['c']],
+        }
+        self.consumer._placeholder = 'a'
+        self.consumer._fetch_items = Mock(
+            side_effect=lambda params, **kwargs: pages[params['before'][3:]])
+        
+        returned_ids = [item.id for item in self.consumer._iter_items()]
+        
+        assert returned_ids == ['b', 'c', 'd', 'e']
+        assert self.consumer._fetch_items.call_count == 3
+    
+    def test_iter_items_placeholder_gone(self):
+        items_list = [Mock(id='b', created_utc=1), Mock(id='c', created_utc=2)]
+        
+        def fetch_items(**kwargs):
+            if 'params' in kwargs:  # page
+                return []
+            return reversed(items_list)
+        
+        self.consumer._placeholder = 'a'
+        self.consumer._fetch_items = Mock(side_effect=fetch_items)
+        assert list(self.consumer._iter_items()) == items_list
+    
+    def process(self, *items):
+        batch = [(item, self.consumer.PROCESSOR(item)) for item in items]
+        self.consumer._process_batch(batch)
     
-    def test_process_item_not_already_processed(self):
-        self.consumer._process_item(Mock(id='a'))
+    @patch('application.deltabot.config.PROCESSING_BATCH_SIZE', 3)
+    def test_iter_batches(self):
+        processor = self.consumer.PROCESSOR.return_value
+        processor._is_queuable = False
+        batches = list(self.consumer._iter_batches(range(7)))
+        assert [len(batch) for batch in batches] == [3, 3, 1]
+    
+    @patch('application.deltabot.config.PROCESSING_BATCH_SIZE', 30)
+    def test_iter_batches_entity_groups_limit(self):
+        processor = self.consumer.PROCESSOR.return_value
+        processor._is_queuable = False
+        batches = list(self.consumer._iter_batches(range(30)))
+        assert [len(batch) for batch in batches] == [24, 6]
+    
+    @patch('application.deltabot.config.PROCESSING_BATCH_SIZE', 20)
+    def test_iter_batches_tasks_limit(self):
+        processor = self.consumer.PROCESSOR.return_value
+        processor._is_queuable = True
+        batches = list(self.consumer._iter_batches(range(7)))
+        assert [len(batch) for batch in batches] == [5, 2]
+    
+    def test_process_batch_updates_placeholder(self):
+        self.process(self.get_item(id='a'), self.get_item(id='b'))
+        assert utils.KVStore_get('foos_placeholder') == 'b'
+    
+    def test_process_batch_updates_processed(self):
+        item = self.get_item()
+        self.process(item)
+        shard = self.consumer._get_processed_items([item]).values()[0]
+        assert 'a' in shard
+        assert 'b' not in shard
+    
+    def test_process_batch_not_already_processed(self):
+        self.process(self.get_item())
         assert self.consumer.PROCESSOR.return_value.run.called
     
-    def test_process_item_already_processed(self):
-        utils.KVStore_set('foos_processed:a')
-        self.consumer._process_item(Mock(id='a'))
-        assert len(self.get_tasks()) == 0
+    def test_process_batch_already_processed(self):
+        self.process(self.get_item())
+        self.consumer.PROCESSOR.reset_mock()
+        self.process(self.get_item())
+        assert not self.consumer.PROCESSOR.return_value.run.called
+    
+    def test_process_batch_legacy_processed(self):
+        utils.KVStore_set('processed_comments:a', parent=bot._LEGACY_ANCESTOR)
+        item = self.get_item()
+        self.process(item)
+        assert not self.consumer.PROCESSOR.return_value.run.called
+        assert 'a' in self.consumer._get_processed_items([item]).values()[0]
+    
+    def test_process_batch_expired(self):
+        created_utc = time.time() - config.PROCESSED_ITEMS_RETENTION - 3600
+        self.process(self.get_item(created_utc=created_utc))
+        assert not self.consumer.PROCESSOR.return_value.run.called
+        assert utils.KVStore_get('foos_placeholder') == 'a'
     
     def test_run_sets_placeholder(self):
         utils.KVStore_set('foos_placeholder', 'a')
@@ -506,27 +1325,147 @@ class TestItemsConsumer(unittest.TestCase, DatastoreTestMixin,
         self.consumer.run()
         assert self.consumer._placeholder == 'a'
     
+    @patch.object(ItemsConsumerMock, 'LEGACY_PLACEHOLDER_KEY', 'foos')
+    def test_run_before_migration(self):
+        legacy_ancestor = bot._LEGACY_ANCESTOR
+        utils.KVStore_set('foos', 'a', parent=legacy_ancestor)
+        utils.KVStore_set('processed_comments:b', parent=legacy_ancestor)
+        now = time.time()
+        items = [self.get_item(id='c', created_utc=now + 1),
+                 self.get_item(id='b', created_utc=now)]
+        self.consumer._fetch_items = Mock(return_value=items)
+        
+        self.consumer.run()
+        
+        params = self.consumer._fetch_items.call_args[1]['params']
+        assert params == {'before': 't0_a'}
+        assert self.consumer.PROCESSOR.return_value.run.call_count == 1
+        assert utils.KVStore_get('foos_placeholder') == 'c'
+    
     def test_run_processes_items(self):
         self.consumer._fetch_items = Mock(return_value=iter([Mock()]))
-        self.consumer._process_item = Mock()
+        self.consumer._process_batch = Mock()
         self.consumer.run()
-        assert self.consumer._process_item.call_count == 1
+        assert self.consumer._process_batch.call_count == 1
+
+
+class TestPurgeProcessedItems(unittest.TestCase, GlobalQueryTestMixin,
+                              TaskQueueTestMixin):
+    def test_purge(self):
+        consumer = ItemsConsumerMock()
+        expired_at = time.time() - config.PROCESSED_ITEMS_RETENTION - 3600
+        expired, recent = sorted(consumer._get_processed_items([
+            Mock(created_utc=expired_at),
+            Mock(created_utc=time.time()),
+        ]).values(), key=attrgetter('bucket'))
+        ndb.put_multi([expired, recent])
+        legacy_ancestor = bot._LEGACY_ANCESTOR
+        utils.KVStore_set('processed_comments:a', parent=legacy_ancestor)
+        utils.KVStore_set('placeholder', parent=legacy_ancestor)
+        utils.KVStore_set(bot.MIGRATED_AT_KEY, str(expired_at))
+        
+        bot.purge_processed_items()
+        
+        assert expired.key.get() is None
+        assert recent.key.get() is not None
+        assert not utils.KVStore_exists('processed_comments:a',
+                                        parent=legacy_ancestor)
+        assert utils.KVStore_exists('placeholder', parent=legacy_ancestor)
+    
+    def test_legacy_markers_kept(self):
+        legacy_ancestor = bot._LEGACY_ANCESTOR
+        utils.KVStore_set('processed_comments:a', parent=legacy_ancestor)
+        bot.purge_processed_items()
+        # Until the migration's end, and the retention period since
+        utils.KVStore_set(bot.MIGRATED_AT_KEY, str(time.time()))
+        bot.purge_processed_items()
+        assert utils.KVStore_exists('processed_comments:a',
+                                    parent=legacy_ancestor)
+
+
+class TestMigrateStorage(unittest.TestCase, GlobalQueryTestMixin,
+                         TaskQueueTestMixin):
+    def setUp(self):
+        legacy_ancestor = bot._LEGACY_ANCESTOR
+        ndb.put_multi([
+            Delta(parent=legacy_ancestor, **_get_delta().to_dict()),
+            UserStats(id='john', delta_count=1, parent=legacy_ancestor),
+            KeyValueStore(id='comments', value='a', parent=legacy_ancestor),
+            KeyValueStore(id='processed_comments:a', parent=legacy_ancestor),
+        ])
+        # Written since the new code was deployed
+        utils.KVStore_set('comments', 'b')
+    
+    def migrate(self):
+        bot.migrate_storage()
+        stub = self.testbed.get_stub('taskqueue')
+        while True:
+            # Not the Reddit updates queued once the stats are rebuilt
+            tasks = stub.get_filtered_tasks(queue_names=['default'])
+            stub.FlushQueue('default')
+            if not tasks:
+                break
+            for task in tasks:
+                deferred.run(task.payload)
+    
+    def test_migrated(self):
+        self.migrate()
+        
+        delta = utils.delta_key('John', '000002').get()
+        assert delta.submission_title == 'Foo'
+        assert UserStats.get_by_id('John').delta_count == 1
+        
+        legacy_keys = (Delta.query(ancestor=bot._LEGACY_ANCESTOR)
+                       .fetch(keys_only=True))
+        assert not legacy_keys
+    
+    def test_existing_kept(self):
+        self.migrate()
+        assert utils.KVStore_get('comments') == 'b'
+    
+    def test_processed_items_left(self):
+        self.migrate()
+        assert utils.KVStore_exists('processed_comments:a',
+                                    parent=bot._LEGACY_ANCESTOR)
+    
+    def test_end_recorded(self):
+        self.migrate()
+        assert utils.KVStore_exists(bot.MIGRATED_AT_KEY)
 
 
-@patch('application.deltabot.utils.praw.Reddit')
+@reddit_test
 class TestCommentsConsumer(unittest.TestCase, DatastoreTestMixin,
                            TaskQueueTestMixin):
     def setUp(self):
         self.consumer = bot.CommentsConsumer()
     
     def test_fetch_items(self, reddit_class):
-        self.consumer._placeholder = 'a'
-        returned_items = self.consumer._fetch_items()
-        assert returned_items == reddit_class.return_value.get_comments(
-            'testsub', limit=None, placeholder='a')
+        returned_items = self.consumer._fetch_items(limit=None)
+        get_comments = reddit_class.return_value.get_comments
+        get_comments.assert_called_with('testsub', limit=None)
+        assert returned_items == get_comments.return_value
+    
+    def test_prefetch(self, reddit_class):
+        parent = Mock(fullname='t1_b')
+        reddit_class.return_value.get_info.return_value = [parent]
+        items = [_get_comment(id='c', parent_id='t1_b'),
+                 _get_comment(id='d', parent_id='t1_b', body='Genius!')]
+        
+        pairs = list(self.consumer._iter_processors(items))
+        
+        reddit_class.return_value.get_info.assert_called_once_with(
+            thing_id=['t1_b'])
+        assert pairs[0][1]._awardee_comment is parent
+    
+    def test_fetch_page(self, reddit_class):
+        self.consumer._fetch_page('a')
+        get_comments = reddit_class.return_value.get_comments
+        get_comments.assert_called_with('testsub', limit=100,
+                                        params={'before': 't1_a'},
+                                        place_holder='a')
 
 
-@patch('application.deltabot.utils.praw.Reddit')
+@reddit_test
 class TestMessagesConsumer(unittest.TestCase, DatastoreTestMixin,
                            TaskQueueTestMixin):
     def setUp(self):
@@ -537,7 +1476,6 @@ class TestMessagesConsumer(unittest.TestCase, DatastoreTestMixin,
         
         reddit_class.return_value.get_messages.return_value = iter([item])
         
-        self.consumer._placeholder = None
-        returned_items = self.consumer._fetch_items()
+        returned_items = self.consumer._fetch_items(limit=None)
         
         assert not hasattr(next(returned_items), 'replies')
@@ -0,0 +1,80 @@
+import unittest
+
+from google.appengine.ext import ndb
+from mock import Mock, patch
+
+from application.deltabot import bot, metrics
+
+
+class TestMetrics(unittest.TestCase):
+    nosegae_memcache = True
+    nosegae_datastore_v3 = True
+    
+    def get_lines(self):
+        return metrics.render_metrics().splitlines()
+    
+    @patch('application.deltabot.metrics.time.time')
+    def test_histogram(self, time_func):
+        time_func.side_effect = [0, 0.3, 10, 10.02]
+        with metrics.timer('foo'):
+            pass
+        with metrics.timer('foo'):
+            pass
+        lines = self.get_lines()
+        bucket_tpl = 'deltabot_stage_seconds_bucket{{le="{}",stage="foo"}} {}'
+        assert bucket_tpl.format('0.01', 0) in lines
+        assert bucket_tpl.format('0.025', 1) in lines
+        assert bucket_tpl.format('0.25', 1) in lines
+        assert bucket_tpl.format('0.5', 2) in lines
+        assert bucket_tpl.format('+Inf', 2) in lines
+        assert 'deltabot_stage_seconds_sum{stage="foo"} 0.32' in lines
+        assert 'deltabot_stage_seconds_count{stage="foo"} 2' in lines
+    
+    def test_flushed_by_outermost_stage(self):
+        with metrics.timer('outer'):
+            with metrics.timer('inner'):
+                pass
+            assert 'deltabot_stage_seconds_count{stage="inner"} 1' not in (
+                self.get_lines())
+        lines = self.get_lines()
+        assert 'deltabot_stage_seconds_count{stage="inner"} 1' in lines
+        assert 'deltabot_stage_seconds_count{stage="outer"} 1' in lines
+    
+    def test_increment_on_commit(self):
+        @ndb.transactional
+        def count(fail):
+            metrics.increment_on_commit(metrics.ITEMS, consumer='foos')
+            if fail:
+                raise ValueError
+        
+        with metrics.timer('foo'):
+            with self.assertRaises(ValueError):
+                count(fail=True)
+            count(fail=False)
+        assert 'deltabot_items_total{consumer="foos"} 1' in self.get_lines()
+    
+    def test_error(self):
+        @metrics.timed('foo')
+        def fail():
+            raise ValueError
+        
+        with self.assertRaises(ValueError):
+            fail()
+        lines = self.get_lines()
+        assert 'deltabot_stage_errors_total{stage="foo"} 1' in lines
+        assert 'deltabot_stage_seconds_count{stage="foo"} 1' in lines
+    
+    def test_counters_added(self):
+        for _ in range(2):
+            with metrics.timer('foo'):
+                metrics.increment(metrics.ITEMS, consumer='comments',
+                                  outcome='processed')
+        assert ('deltabot_items_total{consumer="comments",outcome="processed"}'
+                ' 2' in self.get_lines())
+    
+    def test_check_results(self):
+        processor = bot.DeltaAdder(Mock(author=None, link_id='t3_a'))
+        assert not processor._is_queuable
+        assert ('deltabot_check_results_total{check="queuable",'
+                'processor="DeltaAdder",reason="no_author"} 1'
+                in self.get_lines())
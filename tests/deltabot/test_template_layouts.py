@@ -2,10 +2,10 @@ from datetime import datetime
 import os
 import unittest
 
-from mock import Mock
+from mock import Mock, patch
 
 from application.deltabot import config
-from application.deltabot.utils import render_template
+from application.deltabot.utils import render_template, render_template_cached
 
 config.SUBREDDIT = 'testsub'
 
@@ -21,20 +21,28 @@ def test_wiki_user_layout():
                  awarded_by='mary',
                  awarder_comment_url='http://example.com/',
                  submission_title='foo')
+    row = render_template('wiki/user_history_row.md', delta=delta)
     rendered = render_template('wiki/user_history.md', username='john',
-                               deltas=[delta] * 2)
+                               rows=[row] * 2)
     assert rendered == get_template_double('user_wiki.md')
 
 
 def test_wiki_tracker_layout():
     """Test the wiki/tracker.md template"""
-    delta = Mock(awarded_at=datetime(1970, 1, 1),
-                 awarded_to='john',
-                 awarder_comment_url='http://example.com/')
-    rendered = render_template('wiki/tracker.md', deltas=[delta] * 2)
+    user = Mock(last_awarded_at=datetime(1970, 1, 1),
+                last_awarder_comment_url='http://example.com/',
+                username='john')
+    rendered = render_template('wiki/tracker.md', shard='j',
+                               users=[user] * 2)
     assert rendered == get_template_double('wiki_tracker.md')
 
 
+def test_wiki_tracker_index_layout():
+    """Test the wiki/tracker_index.md template"""
+    rendered = render_template('wiki/tracker_index.md', shards=('a', 'other'))
+    assert rendered == get_template_double('wiki_tracker_index.md')
+
+
 class TemplateTest(unittest.TestCase):
     TEMPLATE_FILENAME = None
     
@@ -71,3 +79,18 @@ class TestDeltaRemoverCommentTemplate(TemplateTest):
                                         removal_reason='abuse')
         expected = get_template_double('comments/delta_remover_not_remind.md')
         assert rendered == expected
+
+
+class TestRenderTemplateCached(unittest.TestCase):
+    def test_same_as_render_template(self):
+        rendered = render_template_cached('messages/command.md',
+                                          error='not_a_mod')
+        assert rendered == render_template('messages/command.md',
+                                           error='not_a_mod')
+    
+    @patch('application.deltabot.utils.render_template',
+           return_value='foo')
+    def test_rendered_once(self, render_template_func):
+        render_template_cached('messages/command.md', error='foo')
+        render_template_cached('messages/command.md', error='foo')
+        assert render_template_func.call_count == 1